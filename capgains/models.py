@@ -7,9 +7,10 @@ from contextlib import contextmanager
 from collections import defaultdict
 from decimal import Decimal
 from datetime import (datetime, timedelta) 
-import math
+from operator import attrgetter
 import csv
 import re
+import io
 
 # 3rd party imports
 import sqlalchemy
@@ -26,12 +27,31 @@ from sqlalchemy import (
     Boolean,
     ForeignKey,
     CheckConstraint,
+    Index,
     or_,
+    and_,
+    func,
+    tuple_,
+    bindparam,
+    select,
+    literal,
+    event,
+    case,
 )
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext import baked
 from sqlalchemy.orm import (
     relationship,
-    backref,
+    aliased,
+    joinedload,
+    selectinload,
+    raiseload,
+    contains_eager,
+    object_session,
 )
+from sqlalchemy.orm.exc import MultipleResultsFound
 
 from ofxtools import ofxalchemy
 from ofxtools.ofxalchemy.models import (
@@ -50,6 +70,102 @@ from ofxtools.ofxalchemy.models import (
 # Local imports
 
 
+# Lot.dtopen may be given in a CSV file in either datetime or date format
+# (ISO 8601, zero-padding optional), or else in "December 09, 2015" format.
+CSV_DATETIME_RE = re.compile(
+    r'^(\d{4})-(\d{1,2})-(\d{1,2})(?: (\d{1,2}):(\d{1,2}):(\d{1,2}))?$')
+CSV_DATE_FORMAT = '%B %d, %Y'
+
+
+# Lot/Gain amounts computed in floats get rounded to this precision when
+# they're stored as Decimals; sanity checks on them allow this much slop.
+QUANTUM = Decimal('0.00000001')
+TOLERANCE = 2 * QUANTUM
+
+
+def toDecimal(value):
+    """ Convert a float (or Decimal) computation result for storage """
+    if not isinstance(value, Decimal):
+        value = Decimal(repr(value))
+    return value.quantize(QUANTUM)
+
+
+def firstOfNextMonth(dt):
+    """ Midnight on the 1st of the month following dt """
+    year, month = divmod(dt.year * 12 + dt.month, 12)
+    return datetime(year, month + 1, 1)
+
+
+# Write buffer size for CSV dumps
+CSV_BUFFERSIZE = 1 << 20
+
+
+def parseCsvDatetime(value):
+    """
+    Parse a datetime from a CSV file.  ISO 8601 values are built straight
+    from the regex match; only the long-hand format goes through strptime().
+    """
+    value = value.strip()
+    match = CSV_DATETIME_RE.match(value)
+    if match:
+        return datetime(*[int(g) for g in match.groups() if g is not None])
+    return datetime.strptime(value, CSV_DATE_FORMAT)
+
+
+class daysBetween(FunctionElement):
+    """
+    SQL expression for the (fractional) number of days elapsed between two
+    datetimes, i.e. daysBetween(start, end)
+    """
+    type = Numeric()
+    name = 'daysBetween'
+
+
+@compiles(daysBetween)
+def _daysBetween(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw) for arg in element.clauses]
+    return 'EXTRACT(EPOCH FROM (%s - %s)) / 86400' % (end, start)
+
+
+@compiles(daysBetween, 'sqlite')
+def _daysBetween_sqlite(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw) for arg in element.clauses]
+    return '(julianday(%s) - julianday(%s))' % (end, start)
+
+
+@compiles(daysBetween, 'mysql')
+def _daysBetween_mysql(element, compiler, **kw):
+    start, end = [compiler.process(arg, **kw) for arg in element.clauses]
+    return 'TIMESTAMPDIFF(SECOND, %s, %s) / 86400' % (start, end)
+
+
+# Keys per SELECT in lookupByKeys(); keeps the bind parameters for a
+# 2-column key under SQLite's default limit of 999.
+LOOKUP_CHUNKSIZE = 400
+
+
+def lookupByKeys(DBSession, model, attrs, keys):
+    """
+    Fetch the instances of model whose natural key (the values of the named
+    attributes) is in keys, with a SELECT per LOOKUP_CHUNKSIZE keys rather
+    than one per key.  Returns a dict mapping key tuples to instances.
+    """
+    getter = attrgetter(*attrs)
+    columns = tuple_(*[getattr(model, attr) for attr in attrs])
+    keys = list(keys)
+    instances = {}
+    for i in range(0, len(keys), LOOKUP_CHUNKSIZE):
+        chunk = keys[i:i + LOOKUP_CHUNKSIZE]
+        instances.update(
+            (getter(instance), instance) for instance in
+            DBSession.query(model).filter(columns.in_(chunk)))
+    return instances
+
+
+# Cache for queries that get run over and over with different parameters
+bakery = baked.bakery()
+
+
 # Our base class needs its tables to share the same metata and class registry as
 # ofxalchemy.models classes in order for relationships to succeed.
 @as_declarative(
@@ -104,6 +220,11 @@ class Lot(Base):
     via transfer/reorg.  A Lot that was ended by a reorg/transfer will have
     NULL dtclose and non-NULL dtend, as well as a non-NULL successor.
 
+    predecessor_id is stored on the successor, referring to the Lot it
+    succeeds.  Databases written by earlier versions have the link the other
+    way around (on the ended Lot, referring to its successor); see
+    "Upgrading an existing database" in README.md to convert them.
+
     An open Lot gets split into multiple Lots by subsequent transactions that
     close only part of the Lot, so each Lot records its own units
     rather than simply referring to its opening transaction.
@@ -131,68 +252,173 @@ class Lot(Base):
         'invacctfrom.id', onupdate='CASCADE', ondelete='CASCADE'),
         nullable=False,
     )
-    account = relationship('INVACCTFROM', backref=backref('lots'))
+    # Loading strategies are chosen per side of each relationship (hence
+    # back_populates rather than backref).  account/security are wanted
+    # for nearly every Lot loaded, so they're fetched in bulk (selectin).
+    # The reverse collections on the ofxalchemy models are set up below
+    # the class.
+    account = relationship('INVACCTFROM', back_populates='lots',
+                           lazy='selectin')
     secinfo_id = Column(Integer, ForeignKey(
         'secinfo.id', onupdate='CASCADE', ondelete='CASCADE'),
         nullable=False,
     )
-    security = relationship('SECINFO', backref=backref('lots'))
+    security = relationship('SECINFO', back_populates='lots',
+                            lazy='selectin')
     opener_id = Column(Integer, ForeignKey(
         'invtran.id', onupdate='CASCADE', ondelete='CASCADE'),
     )
     opener = relationship('INVTRAN', foreign_keys=[opener_id],
-                          backref=backref('openedlots')
+                          back_populates='openedlots',
                          )
     closer_id = Column(Integer, ForeignKey(
         'invtran.id', onupdate='CASCADE', ondelete='CASCADE'),
                        )
     closer = relationship('INVTRAN', foreign_keys=[closer_id],
-                          backref=backref('closedlots')
+                          back_populates='closedlots',
                          )
     starter_id = Column(Integer, ForeignKey(
         'invtran.id', onupdate='CASCADE', ondelete='CASCADE',
     ),)
     starter = relationship('INVTRAN', foreign_keys=[starter_id],
-                           backref=backref('startedlots')
+                           back_populates='startedlots',
                           )
     ender_id = Column(Integer, ForeignKey(
         'invtran.id', onupdate='CASCADE', ondelete='CASCADE',
     ),)
     ender = relationship('INVTRAN', foreign_keys=[ender_id],
-                         backref=backref('endedlots')
+                         back_populates='endedlots',
                         )
     predecessor_id = Column(Integer, ForeignKey(
         'lot.id', onupdate='CASCADE', ondelete='CASCADE'
     ), default=None,)
-    predecessor = relationship('Lot', uselist=False,
-                             backref=backref('successor', remote_side=[id]),
+    predecessor = relationship('Lot', remote_side=[id],
+                               back_populates='successor',
+                              )
+    successor = relationship('Lot', uselist=False,
+                             back_populates='predecessor',
                             )
-
-    __table_args__ = ( CheckConstraint('units * cost >= 0'),)
+    # Only walked for Lots being washed; Gain.doWashSales() loads them in
+    # bulk for those (selectinload), so other Lot queries don't pay for it.
+    gains = relationship('Gain', back_populates='lot')
+
+    __table_args__ = (
+        CheckConstraint('units * cost >= 0'),
+        # asOf() and friends filter on account/security/dtstart/dtend
+        Index('ix_lot_acct_sec_dtstart',
+              'acctfrom_id', 'secinfo_id', 'dtstart', 'dtend'),
+        # Lots that haven't been ended yet
+        Index('ix_lot_open', 'acctfrom_id', 'secinfo_id',
+              postgresql_where=dtend.is_(None),
+              sqlite_where=dtend.is_(None)),
+    )
 
     @property
     def unitCost(self):
         return self.cost / self.units
 
     @classmethod
-    def asOf(cls, DBSession, dtasof, account=None, security=None):
-        """ """
-        lots = DBSession.query(cls).filter(
+    def asOfCriteria(cls, dtasof, account=None, security=None):
+        """
+        Filter criteria selecting Lots held as of the given datetime,
+        optionally restricted to an account and/or security.
+        """
+        criteria = [
             cls.dtstart <= dtasof,
             or_(cls.dtend == None, cls.dtend > dtasof),
-        )
+        ]
         if account:
-            lots = lots.filter(cls.acctfrom_id == account.id)
+            criteria.append(cls.acctfrom_id == account.id)
         if security:
-            lots = lots.filter(cls.secinfo_id == security.id)
-        return lots.order_by(cls.dtopen, cls.id)
+            criteria.append(cls.secinfo_id == security.id)
+        return criteria
+
+    @classmethod
+    def asOf(cls, DBSession, dtasof, account=None, security=None):
+        """
+        Lots held as of the given datetime, optionally restricted to an
+        account and/or security.  Lot.account and Lot.security are loaded
+        eagerly for the whole result (one extra SELECT apiece).
+
+        Returns a Query, so callers can refine it further.
+        """
+        return DBSession.query(cls).options(
+            selectinload(cls.account), selectinload(cls.security),
+        ).filter(
+            *cls.asOfCriteria(dtasof, account, security)
+        ).order_by(cls.dtopen, cls.id)
 
     @classmethod
     def longsAsOf(cls, DBSession, dtasof, account=None, security=None):
-        """ """
+        """ asOf() restricted to long positions """
         return cls.asOf(DBSession, dtasof, account, security).filter(
-            cls.units > 0
+            cls.units > 0)
+
+    @classmethod
+    def _bakedAsOf(cls, DBSession, dtasof, account=None, security=None,
+                   longs=False):
+        """
+        Same Lots as asOf() (or longsAsOf() if longs is set) as a baked query,
+        whose SQL is compiled once per combination of account/security given,
+        for callers that run it over and over.  Returns a baked Result, which
+        can't be refined any further.
+        """
+        bq = bakery(lambda session: session.query(cls).options(
+            selectinload(cls.account), selectinload(cls.security)))
+        bq += lambda q: q.filter(
+            cls.dtstart <= bindparam('dtasof'),
+            or_(cls.dtend == None, cls.dtend > bindparam('dtasof')),
         )
+        params = {'dtasof': dtasof}
+        if account:
+            bq += lambda q: q.filter(
+                cls.acctfrom_id == bindparam('acctfrom_id'))
+            params['acctfrom_id'] = account.id
+        if security:
+            bq += lambda q: q.filter(
+                cls.secinfo_id == bindparam('secinfo_id'))
+            params['secinfo_id'] = security.id
+        if longs:
+            bq += lambda q: q.filter(cls.units > 0)
+        bq += lambda q: q.order_by(cls.dtopen, cls.id)
+        return bq(DBSession).params(**params)
+
+    @classmethod
+    def closeableBy(cls, DBSession, invtran):
+        """
+        Lots of invtran's account & security held as of its trade date, whose
+        units are of the opposite sign to invtran's (i.e. Lots that a trade
+        would close), in the same order as asOf().
+
+        This runs for every trade, so it's a baked query: the SQL is compiled
+        once and only the bind parameters change from call to call.
+        """
+        bq = bakery(lambda session: session.query(cls).options(
+            selectinload(cls.account), selectinload(cls.security)))
+        bq += lambda q: q.filter(
+            cls.dtstart <= bindparam('dtasof'),
+            or_(cls.dtend == None, cls.dtend > bindparam('dtasof')),
+            cls.acctfrom_id == bindparam('acctfrom_id'),
+            cls.secinfo_id == bindparam('secinfo_id'),
+            cls.units * bindparam('units') < 0,
+        ).order_by(cls.dtopen, cls.id)
+        return bq(DBSession).params(
+            dtasof=invtran.dttrade, acctfrom_id=invtran.acctfrom.id,
+            secinfo_id=invtran.secinfo.id, units=invtran.units,
+        ).all()
+
+    @classmethod
+    def sumUnitsAsOf(cls, DBSession, dtasof, account=None, security=None,
+                     longs=False):
+        """
+        Total units of the Lots returned by asOf() (or longsAsOf() if longs
+        is set), summed by the DB without loading any Lots.
+        """
+        criteria = cls.asOfCriteria(dtasof, account, security)
+        if longs:
+            criteria.append(cls.units > 0)
+        units = DBSession.query(func.sum(cls.units)).filter(*criteria).scalar()
+        return units or Decimal('0')
 
     csvFields = ('brokerid', 'acctid',
                  'ticker', 'secname', 'uniqueidtype', 'uniqueid',
@@ -200,59 +426,112 @@ class Lot(Base):
     @classmethod
     def loadCsv(cls, DBSession, csvfile):
         """
+        Load Lots from a CSV file in the format written by dumpCsv().
+
+        Accounts and securities are resolved with one query apiece for the
+        whole file (creating any that are missing), then the Lots are
+        INSERTed in bulk without going through the ORM unit of work.
+
+        Returns the newly created Lots.
         """
         with open(csvfile) as csvfile:
             # Treat the first row as column headers
-            #reader = csv.DictReader(csvfile, cls.csvFields)
-            reader = csv.DictReader(csvfile)
-            lots = []
-            for row in reader:
-                # If a matching account already exists in the DB, use it.
-                # Otherwise create one.
-                account = INVACCTFROM.lookupByPk(
-                    DBSession, brokerid=row['brokerid'], acctid=row['acctid'],
-                )
-                if account is None:
-                    account = INVACCTFROM(
-                        brokerid=row['brokerid'], acctid=row['acctid'],
-                    )
-                    DBSession.add(account)
-
-                # If a matching SECINFO already exists in the DB, use it.
-                # Otherwise create an OTHERINFO (we don't know what it is,
-                # and it doesn't matter very much for our purposes)
-                secinfo = SECINFO.lookupByPk(
-                    DBSession, uniqueid=row['uniqueid'],
-                    uniqueidtype=row['uniqueidtype'],
-                )
-                if secinfo is None:
-                    secinfo = ofxalchemy.models.OTHERINFO(
-                        uniqueidtype=row['uniqueidtype'],
-                        uniqueid=row['uniqueid'],
-                        secname=row['secname'],
-                        ticker=row['ticker'],
-                    )
-                # Now use the SECINFO to look up or create the security.
-                # Accept either datetime format or date (ISO 8601)
-                # Or try to accept "December 09, 2015" format
-                dtopen = row['dtopen'].strip()
-                try:
-                    dtopen = datetime.strptime(dtopen, '%Y-%m-%d %H:%M:%S')
-                except ValueError:
-                    try:
-                        dtopen = datetime.strptime(dtopen, '%Y-%m-%d')
-                    except ValueError:
-                        dtopen = datetime.strptime(dtopen, '%B %d, %Y')
-
-                lot = cls(account=account, security=secinfo,
-                          dtstart=dtopen, dtopen=dtopen,
-                          units=Decimal(row['units']),
-                          cost=Decimal(row['cost']),
-                          washcost = Decimal(row['washcost']),
-                         )
-                DBSession.add(lot)
-                lots.append(lot)
-            return lots
+            rows = list(csv.DictReader(csvfile))
+
+        accounts = cls._resolveAccounts(DBSession, rows)
+        secinfos = cls._resolveSecinfos(DBSession, rows)
+
+        mappings = []
+        for row in rows:
+            dtopen = parseCsvDatetime(row['dtopen'])
+            mappings.append({
+                'acctfrom_id': accounts[(row['brokerid'], row['acctid'])].id,
+                'secinfo_id': secinfos[(row['uniqueidtype'],
+                                        row['uniqueid'])].id,
+                'dtopen': dtopen, 'dtstart': dtopen,
+                'units': Decimal(row['units']),
+                'cost': Decimal(row['cost']),
+                'washcost': Decimal(row['washcost']),
+            })
+
+        # Bulk INSERTs don't hand back the new Lots, so remember where the
+        # primary key sequence stood and fetch everything after it.
+        lastid = DBSession.query(func.max(cls.id)).scalar() or 0
+        if DBSession.get_bind().dialect.name == 'postgresql':
+            cls._copyMappings(DBSession, mappings)
+        else:
+            DBSession.bulk_insert_mappings(cls, mappings)
+        return DBSession.query(cls).filter(cls.id > lastid).order_by(
+            cls.id).all()
+
+    copyColumns = ('acctfrom_id', 'secinfo_id', 'dtopen', 'dtstart',
+                   'units', 'cost', 'washcost')
+    @classmethod
+    def _copyMappings(cls, DBSession, mappings):
+        """
+        PostgreSQL fast path for loadCsv(): stream Lot mappings straight into
+        the table with COPY instead of INSERT.  Runs on the Session's own
+        connection, so it's part of the same transaction.
+        """
+        buf = io.StringIO()
+        csv.writer(buf).writerows(
+            [mapping[column] for column in cls.copyColumns]
+            for mapping in mappings)
+        buf.seek(0)
+        cursor = DBSession.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY %s (%s) FROM STDIN WITH CSV' % (
+                    cls.__table__.name, ', '.join(cls.copyColumns)),
+                buf)
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def _resolveAccounts(DBSession, rows):
+        """
+        Map (brokerid, acctid) to INVACCTFROM for every account referenced
+        by the CSV rows.  If a matching account already exists in the DB,
+        use it.  Otherwise create one.
+        """
+        keys = {(row['brokerid'], row['acctid']) for row in rows}
+        if not keys:
+            return {}
+        accounts = lookupByKeys(DBSession, INVACCTFROM,
+                                ('brokerid', 'acctid'), keys)
+        missing = [INVACCTFROM(brokerid=brokerid, acctid=acctid)
+                   for (brokerid, acctid) in keys - set(accounts)]
+        if missing:
+            DBSession.add_all(missing)
+            DBSession.flush()
+            accounts.update({(acct.brokerid, acct.acctid): acct
+                             for acct in missing})
+        return accounts
+
+    @staticmethod
+    def _resolveSecinfos(DBSession, rows):
+        """
+        Map (uniqueidtype, uniqueid) to SECINFO for every security referenced
+        by the CSV rows.  If a matching SECINFO already exists in the DB, use
+        it.  Otherwise create an OTHERINFO (we don't know what it is, and it
+        doesn't matter very much for our purposes)
+        """
+        rows = {(row['uniqueidtype'], row['uniqueid']): row for row in rows}
+        if not rows:
+            return {}
+        secinfos = lookupByKeys(DBSession, SECINFO,
+                                ('uniqueidtype', 'uniqueid'), rows)
+        missing = [ofxalchemy.models.OTHERINFO(
+                       uniqueidtype=uniqueidtype, uniqueid=uniqueid,
+                       secname=rows[(uniqueidtype, uniqueid)]['secname'],
+                       ticker=rows[(uniqueidtype, uniqueid)]['ticker'],
+                   ) for (uniqueidtype, uniqueid) in set(rows) - set(secinfos)]
+        if missing:
+            DBSession.add_all(missing)
+            DBSession.flush()
+            secinfos.update({(sec.uniqueidtype, sec.uniqueid): sec
+                             for sec in missing})
+        return secinfos
 
     @classmethod
     def dumpCsv(cls, DBSession, csvfile, dtasof=None, consolidate=False):
@@ -269,44 +548,40 @@ class Lot(Base):
         Column 10: washcost
         """
         dtasof = dtasof or datetime.max
-        with open(csvfile, 'w') as csvfile:
-            csvwriter = csv.DictWriter(csvfile, cls.csvFields, delimiter=',')
-            csvwriter.writeheader()
-            lots = cls.asOf(DBSession, dtasof)
+        # Rows are small; a large write buffer keeps the syscalls few
+        with open(csvfile, 'w', buffering=CSV_BUFFERSIZE) as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=',')
+            csvwriter.writerow(cls.csvFields)
+            # Stream Lots from the DB in batches.  Lot.account/Lot.security
+            # are joined in (selectinload doesn't mix with yield_per); make
+            # sure no other relationship sneaks in a SELECT per Lot.
+            lots = DBSession.query(cls).options(
+                joinedload(cls.account), joinedload(cls.security),
+                raiseload('*'),
+            ).filter(*cls.asOfCriteria(dtasof)).order_by(
+                cls.dtopen, cls.id).yield_per(1000)
             if consolidate:
                 # Consolidate Lots by account/secinfo, 
-                # disregarding dtopen/washcost
-                p = defaultdict(list)
+                # disregarding dtopen/washcost.  Keep running totals
+                # rather than collecting every Lot.
+                p = defaultdict(lambda: [Decimal('0'), Decimal('0')])
                 for lot in lots:
-                    secinfo = lot.security
-                    p[(lot.account, secinfo)].append((lot.units, lot.cost))
-                for (account, secinfo), lots in p.items():
-                    position = {'brokerid': account.brokerid,
-                                'acctid': account.acctid,
-                                'ticker': secinfo.ticker,
-                                'secname': secinfo.secname,
-                                'uniqueidtype': secinfo.uniqueidtype,
-                                'uniqueid': secinfo.uniqueid,
-                                'units': sum([l[0] for l in lots]),
-                                'cost': sum([l[1] for l in lots]),
-                               }
-                    csvwriter.writerow(position)
+                    totals = p[(lot.account, lot.security)]
+                    totals[0] += lot.units
+                    totals[1] += lot.cost
+                csvwriter.writerows(
+                    (account.brokerid, account.acctid,
+                     secinfo.ticker, secinfo.secname,
+                     secinfo.uniqueidtype, secinfo.uniqueid,
+                     None, units, cost, None)
+                    for (account, secinfo), (units, cost) in p.items())
             else:
-                for lot in lots:
-                    account = lot.account
-                    secinfo = lot.security
-                    position = {'brokerid': account.brokerid,
-                                'acctid': account.acctid,
-                                'ticker': secinfo.ticker,
-                                'secname': secinfo.secname,
-                                'uniqueidtype': secinfo.uniqueidtype,
-                                'uniqueid': secinfo.uniqueid,
-                                'dtopen': lot.dtopen,
-                                'units': lot.units,
-                                'cost': lot.cost,
-                                'washcost': int(lot.washcost),
-                               }
-                    csvwriter.writerow(position)
+                csvwriter.writerows(
+                    (lot.account.brokerid, lot.account.acctid,
+                     lot.security.ticker, lot.security.secname,
+                     lot.security.uniqueidtype, lot.security.uniqueid,
+                     lot.dtopen, lot.units, lot.cost, int(lot.washcost))
+                    for lot in lots)
 
     #@classmethod
     #def wipe(cls, DBSession):
@@ -315,34 +590,43 @@ class Lot(Base):
 
     @classmethod
     def doInvtrans(cls, DBSession, dtstart=None, dtend=None):
+        """
+        Process all INVTRANs traded within the given period, in order.
+
+        INVTRANs are processed a calendar month at a time, committing the
+        resulting Lots/Gains after each month.  Processed INVTRANs are
+        logged (OfxLog), so an interrupted run can simply be restarted.
+        """
         dtstart = dtstart or datetime.min
         dtend = dtend or datetime.max
-        invtrans = DBSession.query(INVTRAN).filter(
-            INVTRAN.dttrade >= dtstart,
-            INVTRAN.dttrade <= dtend,
-        ).order_by(INVTRAN.dttrade, INVTRAN.id)
-        for invtran in invtrans:
-            cls.doInvtran(DBSession, invtran)
+        inPeriod = (INVTRAN.dttrade >= dtstart, INVTRAN.dttrade <= dtend)
+        dtfirst, dtlast = DBSession.query(
+            func.min(INVTRAN.dttrade), func.max(INVTRAN.dttrade)
+        ).filter(*inPeriod).one()
+        if dtfirst is None:
+            return
+
+        chunkStart = dtfirst
+        while chunkStart <= dtlast:
+            chunkEnd = firstOfNextMonth(chunkStart)
+            invtrans = DBSession.query(INVTRAN).filter(
+                *inPeriod
+            ).filter(
+                INVTRAN.dttrade >= chunkStart,
+                INVTRAN.dttrade < chunkEnd,
+            ).options(joinedload(INVTRAN.acctfrom)).order_by(
+                INVTRAN.dttrade, INVTRAN.id).yield_per(1000)
+            for invtran in invtrans:
+                cls.doInvtran(DBSession, invtran)
+            DBSession.commit()
+            chunkStart = chunkEnd
 
     @classmethod
     def doInvtran(cls, DBSession, invtran):
-        """ """
-        # First check for broker quirks
-        quirks = brokerquirks.get(invtran.acctfrom.brokerid, None)
-        if quirks:
-            method = quirks.get(type(invtran), None)
-            if method:
-                method(DBSession, invtran)
-                return
-        if isinstance(invtran, INVBUYSELL):
-            cls.trade(DBSession, invtran)
-        elif isinstance(invtran, RETOFCAP):
-            cls.returnOfCapital(DBSession, invtran)
-        elif isinstance(invtran, SPLIT):
-            cls.split(DBSession, invtran)
-        else:
-            return
-
+        """ Hand off invtran to the handler for its broker & type, if any """
+        handler = invtranHandler(invtran.acctfrom.brokerid, type(invtran))
+        if handler:
+            handler(DBSession, invtran)
 
     @classmethod
     def trade(cls, DBSession, invtran):
@@ -357,60 +641,131 @@ class Lot(Base):
             return
 
         # FIXME - FIFO is hard coded, but this should be configurable.
-        openLots = cls.asOf(DBSession, invtran.dttrade,
-                            account=invtran.acctfrom, security=invtran.secinfo
-                           ).filter(cls.units * invtran.units < 0)
+        # closeableBy() materializes the Lots in a single SELECT.
+        openLots = cls.closeableBy(DBSession, invtran)
+        cls._close(DBSession, invtran, openLots)
 
-        # Match incoming INVTRAN units to open Lot units
-        # until one or the other runs out
-        units = invtran.units
+    @classmethod
+    def doTrades(cls, DBSession, invtrans):
+        """
+        Process several trades; same results as calling trade() on each in
+        order of dttrade.
 
-        logging.info("Trade - original INVTRAN units: %s" % units)
+        Rather than a closeableBy() SELECT per trade, the Lots each
+        account/security's trades might close are fetched together, matched
+        to the trades in memory, and everything is flushed at the end.
+        """
+        invtrans = sorted(invtrans, key=attrgetter('dttrade'))
+        for invtran in invtrans:
+            if not isinstance(invtran, ofxalchemy.models.INVBUYSELL):
+                raise ValueError('%s is not a trade' % invtran)
+        DBSession.add_all(invtrans)
+        # Assign INVTRAN ids (and acctfrom_id/secinfo_id) before grouping
+        DBSession.flush()
 
-        for lot in openLots:
-            if units == 0:
-                break
+        groups = defaultdict(list)
+        for invtran in invtrans:
+            groups[(invtran.acctfrom_id, invtran.secinfo_id)].append(invtran)
+
+        # Lots in order of closeableBy(); ones not yet flushed (id None) were
+        # created later than those that have been.
+        fifo = lambda lot: (lot.dtopen, lot.id is None, lot.id or 0)
+
+        pools = {}
+        with DBSession.no_autoflush:
+            for invtran in invtrans:
+                t, created = OfxLog.get_or_create(DBSession, invtran)
+                if not created:
+                    continue
+
+                key = (invtran.acctfrom_id, invtran.secinfo_id)
+                if key not in pools:
+                    # Every Lot held at some point during the group's trades
+                    group = groups[key]
+                    pools[key] = DBSession.query(cls).filter(
+                        cls.acctfrom_id == key[0],
+                        cls.secinfo_id == key[1],
+                        cls.dtstart <= group[-1].dttrade,
+                        or_(cls.dtend == None, cls.dtend > group[0].dttrade),
+                    ).order_by(cls.dtopen, cls.id).all()
+                pool = pools[key]
+
+                dttrade = invtran.dttrade
+                openLots = sorted(
+                    [lot for lot in pool
+                     if lot.dtstart <= dttrade
+                     and (lot.dtend is None or lot.dtend > dttrade)
+                     and lot.units * invtran.units < 0],
+                    key=fifo)
+                pool.extend(cls._close(DBSession, invtran, openLots))
+        DBSession.flush()
 
-            logging.info("  Remaining INVTRAN units: %s" % units)
-            logging.info("  vs. Lot units: %s" % lot.units)
+    @classmethod
+    def _close(cls, DBSession, invtran, openLots):
+        """
+        Close openLots (in order) against trade invtran, recording Gains.
+        Returns the Lots created: the unclosed remainder of a split Lot,
+        and/or a new Lot opened with any units left over from invtran.
+        """
+        created = []
 
-            if abs(units) >= abs(lot.units):
-                # More incoming units than Lot units
-                # Close the whole Lot and continue the loop
-                units = units + lot.units
-            else:
-                # More Lot units than incoming units - split the Lot
-                # Close the incoming units and leave the rest open
-                unitsOpen = units + lot.units
-                costOpen = unitsOpen * lot.unitCost
-                lot.units = -units
-                lot.cost -= costOpen
-                openLot = cls(
-                    account=lot.account, security=lot.security,
-                    units=unitsOpen, cost=costOpen,
-                    dtopen=lot.dtopen, opener=lot.opener,
-                    dtstart=lot.dtstart, starter=lot.starter,
-                )
-                DBSession.add(openLot)
-                DBSession.commit()
+        # Match incoming INVTRAN units to open Lot units
+        # until one or the other runs out
+        units = invtran.units
+        # Same for every Lot closed; Decimal division is the costly op here
+        unitProceeds = -invtran.total / units
+
+        logging.info("Trade - original INVTRAN units: %s", units)
+
+        # openLots is already a list, so nothing needs to be fetched
+        # mid-loop; don't let relationship loads (lot.account, lot.opener...)
+        # autoflush the pending Gains/Lots on every iteration.
+        with DBSession.no_autoflush:
+            for lot in openLots:
+                if units == 0:
+                    break
+
+                logging.info("  Remaining INVTRAN units: %s", units)
+                logging.info("  vs. Lot units: %s", lot.units)
+
+                if abs(units) >= abs(lot.units):
+                    # More incoming units than Lot units
+                    # Close the whole Lot and continue the loop
+                    units = units + lot.units
+                else:
+                    # More Lot units than incoming units - split the Lot
+                    # Close the incoming units and leave the rest open
+                    unitsOpen = units + lot.units
+                    costOpen = unitsOpen * lot.unitCost
+                    lot.units = -units
+                    lot.cost -= costOpen
+                    openLot = cls(
+                        account=lot.account, security=lot.security,
+                        units=unitsOpen, cost=costOpen,
+                        dtopen=lot.dtopen, opener=lot.opener,
+                        dtstart=lot.dtstart, starter=lot.starter,
+                    )
+                    DBSession.add(openLot)
+                    created.append(openLot)
 
-                units = Decimal('0') # Break the loop next time around
+                    units = Decimal('0') # Break the loop next time around
 
-                logging.info("  INVTRAN units all used up - split Lot")
-                logging.info("  Leftover Lot: %s" % openLot)
+                    logging.info("  INVTRAN units all used up - split Lot")
+                    logging.info("  Leftover Lot: %s", openLot)
 
-            lot.dtclose = invtran.dttrade 
-            lot.closer = invtran
-            lot.dtend = lot.dtclose
-            lot.ender = lot.closer
-            proceeds = lot.units / invtran.units * -invtran.total
-            gain = Gain(proceeds=proceeds, lot=lot, transaction=invtran)
-            DBSession.add(gain)
+                lot.dtclose = invtran.dttrade 
+                lot.closer = invtran
+                lot.dtend = lot.dtclose
+                lot.ender = lot.closer
+                proceeds = lot.units * unitProceeds
+                gain = Gain(proceeds=proceeds, lot=lot, transaction=invtran)
+                DBSession.add(gain)
 
-            logging.info("  Closed Lot: %s" % lot)
-            logging.info("  Gain: %s (units=%s, cost=%s, value=%s"  % \
-                         (gain, gain.units, gain.cost, gain.value)
-                        )
+                logging.info("  Closed Lot: %s", lot)
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    # Don't evaluate the Gain's properties just to discard them
+                    logging.info("  Gain: %s (units=%s, cost=%s, value=%s",
+                                 gain, gain.units, gain.cost, gain.value)
 
         # If any more incoming INVTRAN units remain, open a new Lot with them.
         if units:
@@ -421,6 +776,9 @@ class Lot(Base):
                 dtstart=invtran.dttrade, starter=invtran,
             )
             DBSession.add(newLot)
+            created.append(newLot)
+
+        return created
 
 
     @classmethod
@@ -435,8 +793,8 @@ class Lot(Base):
             return
 
         dtasof = invtran.dttrade
-        lots = cls.longsAsOf(DBSession, dtasof, security=invtran.secinfo)
-        totalUnits = sum([lot.units for lot in lots])
+        totalUnits = cls.sumUnitsAsOf(DBSession, dtasof,
+                                      security=invtran.secinfo, longs=True)
         try:
             assert totalUnits
         except AssertionError:
@@ -445,25 +803,60 @@ class Lot(Base):
         unitRetofcap = invtran.total / totalUnits
 
         # Create new Lots as of the return of capital so that queries before/after
-        # that date will return the correct cost at that time.
-        for lot in lots:
-            costAdj = lot.units * unitRetofcap
-            adjCost = lot.cost - costAdj
-
-            lot.ender = invtran
-            lot.dtend = dtasof
-            newLot = Lot(account=lot.account, security=lot.security,
-                         units=lot.units, cost=adjCost,
-                         washcost=lot.washcost, predecessor=lot,
-                         opener=lot.opener, dtopen=lot.dtopen,
-                         starter=invtran, dtstart=dtasof,
-                        )
-            DBSession.add(newLot)
+        # that date will return the correct cost at that time.  This is done
+        # in SQL, so it takes the same few statements however many Lots are
+        # held.  Any return of capital beyond a Lot's cost is realized as a
+        # Gain, and the new Lot's cost is floored at zero.
+        def adjCost(lot):
+            return func.round(
+                lot.cost - lot.units * literal(unitRetofcap, Numeric), 8,
+                type_=Numeric)
+
+        criteria = cls.asOfCriteria(dtasof, security=invtran.secinfo)
+        criteria.append(cls.units > 0)
+        cls._succeed(DBSession, invtran, criteria,
+                     cost=case([(adjCost(cls) < 0, 0)], else_=adjCost(cls)))
+
+        # Only the (few) Lots whose cost went negative need to be loaded
+        predecessor = aliased(cls)
+        overpaid = DBSession.query(cls, adjCost(predecessor)).join(
+            predecessor, cls.predecessor_id == predecessor.id).filter(
+                cls.starter_id == invtran.id, adjCost(predecessor) < 0)
+        for newLot, cost in overpaid:
+            gain = Gain(proceeds=-cost.quantize(QUANTUM), lot=newLot,
+                        transaction=invtran)
+            DBSession.add(gain)
 
-            if  adjCost < 0:
-                newLot.cost = 0
-                gain = Gain(proceeds=-adjCost, lot=newLot, transaction=invtran)
-                DBSession.add(gain)
+    @classmethod
+    def _succeed(cls, DBSession, invtran, criteria, units=None, cost=None):
+        """
+        End all Lots matching criteria as of invtran, and start a successor
+        Lot for each of them.  units/cost are optional SQL expressions
+        (in terms of the predecessor Lot) for the successors' units/cost;
+        by default they're carried over unchanged.
+
+        This is one UPDATE and one INSERT ... SELECT, so it doesn't depend on
+        the number of Lots affected.
+        """
+        dtasof = invtran.dttrade
+        # Bulk statements bypass the unit of work; make sure they see
+        # everything pending (including invtran itself).
+        DBSession.flush()
+        DBSession.query(cls).filter(*criteria).update(
+            {cls.dtend: dtasof, cls.ender_id: invtran.id},
+            synchronize_session='fetch')
+
+        successors = select([
+            cls.acctfrom_id, cls.secinfo_id,
+            cls.units if units is None else units,
+            cls.cost if cost is None else cost,
+            cls.washcost, cls.id, cls.opener_id, cls.dtopen,
+            literal(invtran.id, Integer), literal(dtasof, DateTime),
+        ]).where(and_(cls.ender_id == invtran.id, cls.dtend == dtasof))
+        DBSession.execute(cls.__table__.insert().from_select(
+            ['acctfrom_id', 'secinfo_id', 'units', 'cost', 'washcost',
+             'predecessor_id', 'opener_id', 'dtopen', 'starter_id', 'dtstart'],
+            successors))
 
 
     @classmethod
@@ -484,25 +877,15 @@ class Lot(Base):
         if  ratio != invtran.numerator / invtran.denominator:
             raise ValueError('Inconsistent ratio vs. units for %s' % invtran)
 
-        # List of Lots are subject to the split
-        dtasof = invtran.dttrade
-        lots = cls.asOf(DBSession, dtasof, security=invtran.secinfo)
-
-        newUnits = Decimal('0')
         # Create new Lots as of the split date so that queries before/after
         # that date will return the correct units at that time.
-        for lot in lots:
-            lot.ender = invtran
-            lot.dtend = dtasof
-            newLot = Lot(account=lot.account, security=lot.security,
-                         units=lot.units * ratio, cost=lot.cost,
-                         washcost=lot.washcost, predecessor=lot,
-                         opener=lot.opener, dtopen=lot.dtopen,
-                         starter=invtran, dtstart=dtasof,
-                        )
-            DBSession.add(newLot)
-            newUnits += newLot.units
+        dtasof = invtran.dttrade
+        criteria = cls.asOfCriteria(dtasof, security=invtran.secinfo)
+        cls._succeed(DBSession, invtran, criteria,
+                     units=cls.units * literal(ratio, Numeric))
 
+        newUnits = DBSession.query(func.sum(cls.units)).filter(
+            cls.starter_id == invtran.id).scalar() or Decimal('0')
         try:
             assert abs(newUnits - invtran.newunits) < Decimal('0.00000001')
         except AssertionError:
@@ -511,6 +894,31 @@ class Lot(Base):
             raise
 
 
+# Reverse sides of the Lot relationships on the ofxalchemy models.  Nothing
+# here walks from an account/security to its Lots, and those collections can
+# be huge, so they're dynamic (i.e. a Query, loaded only on request).  The
+# INVTRAN collections are never walked at all; don't load them.
+INVACCTFROM.lots = relationship(Lot, back_populates='account', lazy='dynamic')
+SECINFO.lots = relationship(Lot, back_populates='security', lazy='dynamic')
+INVTRAN.openedlots = relationship(Lot, foreign_keys=[Lot.opener_id],
+                                  back_populates='opener', lazy='noload')
+INVTRAN.closedlots = relationship(Lot, foreign_keys=[Lot.closer_id],
+                                  back_populates='closer', lazy='noload')
+INVTRAN.startedlots = relationship(Lot, foreign_keys=[Lot.starter_id],
+                                   back_populates='starter', lazy='noload')
+INVTRAN.endedlots = relationship(Lot, foreign_keys=[Lot.ender_id],
+                                 back_populates='ender', lazy='noload')
+
+
+# Indexes on the ofxalchemy INVTRAN table (TRANSFER, INVEXPENSE etc. keep
+# acctfrom_id/dttrade there).  doInvtrans() scans INVTRANs by dttrade a month
+# at a time; the IBKR twin/reversal matching looks up INVTRANs by account and
+# trade date.
+Index('ix_invtran_dttrade', INVTRAN.__table__.c.dttrade)
+Index('ix_invtran_acctfrom_dttrade',
+      INVTRAN.__table__.c.acctfrom_id, INVTRAN.__table__.c.dttrade)
+
+
 class Gain(Base):
     """
     Capital gain realized by a transaction in a Lot of a security.
@@ -531,52 +939,94 @@ class Gain(Base):
                                onupdate='CASCADE', ondelete='CASCADE'),
                     nullable=False,
                    )
-    lot = relationship('Lot', backref=backref('gains'))
+    lot = relationship('Lot', back_populates='gains')
     invtran_id = Column(Integer,
                         ForeignKey('invtran.id',
                                    onupdate='CASCADE', ondelete='CASCADE'),
                        )
     transaction = relationship('INVTRAN')
 
-    @property
+    __table_args__ = (
+        # doWashSales() looks for Gains that haven't been washed yet
+        Index('ix_gain_washloss_lotid', 'washloss', 'lot_id'),
+        # Gains are joined to/looked up by their realizing INVTRAN
+        Index('ix_gain_invtran', 'invtran_id'),
+    )
+
+    # These are hybrids so that reports can have the DB compute them, e.g.
+    # DBSession.query(func.sum(Gain.value)).  At the class level, attributes
+    # of the Lot/INVTRAN are correlated subqueries, so no join is required.
+    @classmethod
+    def _lotAttr(cls, column):
+        return select([column]).where(
+            Lot.id == cls.lot_id).correlate(cls.__table__).as_scalar()
+
+    @hybrid_property
     def units(self):
         return self.lot.units
 
-    @property
+    @units.expression
+    def units(cls):
+        return cls._lotAttr(Lot.units)
+
+    @hybrid_property
     def cost(self):
         return self.lot.cost
 
-    @property
+    @cost.expression
+    def cost(cls):
+        return cls._lotAttr(Lot.cost)
+
+    @hybrid_property
     def value(self):
         return self.proceeds - self.cost
 
-    @property
+    @hybrid_property
     def washcost(self):
         return self.lot.washcost
 
-    @property
+    @washcost.expression
+    def washcost(cls):
+        return cls._lotAttr(Lot.washcost)
+
+    @hybrid_property
     def taxcost(self):
         return self.cost + self.washcost
 
-    @property
+    @hybrid_property
     def taxvalue(self):
         return self.proceeds - self.taxcost
 
-    @property
+    @hybrid_property
     def dtopen(self):
         return self.lot.dtopen
 
-    @property
+    @dtopen.expression
+    def dtopen(cls):
+        return cls._lotAttr(Lot.dtopen)
+
+    @hybrid_property
     def dtclose(self):
         return self.transaction.dttrade
 
-    @property
+    @dtclose.expression
+    def dtclose(cls):
+        return select([INVTRAN.dttrade]).where(
+            INVTRAN.id == cls.invtran_id).correlate(cls.__table__).as_scalar()
+
+    @hybrid_property
     def isLongTerm(self):
         # Short sales always generate STCG
         if self.units < 0:
             return False
+        # Whole 24-hour periods held, not calendar days
         return (self.dtclose - self.dtopen).days > 365
 
+    @isLongTerm.expression
+    def isLongTerm(cls):
+        # More than 365 whole days <=> at least 366 days
+        return and_(cls.units > 0, daysBetween(cls.dtopen, cls.dtclose) >= 366)
+
     @classmethod
     def doWashSales(cls, DBSession, dtstart=None, dtend=None):
         """ """
@@ -590,20 +1040,77 @@ class Gain(Base):
             Lot.dtclose != None,
             Lot.dtopen > dtstart,
             Lot.dtopen <= dtend,
-        ).order_by(Lot.dtopen)
+        ).options(
+            # doWashSale() walks each loss Lot's Gains & their transactions
+            contains_eager(cls.lot).selectinload(Lot.gains).joinedload(
+                cls.transaction),
+        ).order_by(Lot.dtopen).all()
+        if not gains:
+            return
 
-        [ gain.doWashSale(DBSession) for gain in gains ]
+        # Rather than querying replacement Lots for each Gain, fetch every
+        # candidate Lot for all the Gains in one go (a SELECT per
+        # LOOKUP_CHUNKSIZE account/security pairs, as in lookupByKeys()),
+        # and hand each Gain the pool for its account/security.
+        dtcloses = [gain.lot.dtclose for gain in gains]
+        keys = list(
+            {(gain.lot.acctfrom_id, gain.lot.secinfo_id) for gain in gains})
+        pools = defaultdict(list)
+        for i in range(0, len(keys), LOOKUP_CHUNKSIZE):
+            candidates = DBSession.query(Lot).filter(
+                tuple_(Lot.acctfrom_id, Lot.secinfo_id).in_(
+                    keys[i:i + LOOKUP_CHUNKSIZE]),
+                Lot.washcost == 0,
+                Lot.dtopen >= min(dtcloses) - timedelta(days=30),
+                Lot.dtopen <= max(dtcloses) + timedelta(days=30),
+            ).options(
+                # ...and those of any replacement Lot that gets split
+                selectinload(Lot.gains).joinedload(cls.transaction),
+            ).order_by(Lot.dtopen, Lot.id)
+            for lot in candidates:
+                pools[(lot.acctfrom_id, lot.secinfo_id)].append(lot)
+
+        for gain in gains:
+            pool = pools[(gain.lot.acctfrom_id, gain.lot.secinfo_id)]
+            gain.doWashSale(DBSession, candidateLots=pool)
+
+    @staticmethod
+    def replacementCriteria():
+        """
+        Filter criteria for doWashSale()'s baked replacement Lot queries,
+        parametrized by bindparams 'lot_id', 'acctfrom_id', 'secinfo_id',
+        'units' (of the loss Lot), and 'dtmin'/'dtmax' (the 61-day window).
+        """
+        return (
+            Lot.id != bindparam('lot_id'),
+            Lot.acctfrom_id == bindparam('acctfrom_id'),
+            Lot.secinfo_id == bindparam('secinfo_id'),
+            Lot.units * bindparam('units') > 0,
+            Lot.washcost == 0,
+            Lot.dtopen >= bindparam('dtmin'),
+            Lot.dtopen <= bindparam('dtmax'),
+        )
 
-    def doWashSale(self, DBSession):
-        logging.info('Evaluating wash sale for %s(lot=%s, transaction=%s)' % \
-                     (self, self.lot, self.transaction)
-                    )
+    def doWashSale(self, DBSession, candidateLots=None):
+        """
+        Disallow loss on this Gain to the extent of replacement shares bought
+        within 30 days, rolling it into the replacement Lots' cost basis.
+
+        By default, replacement Lots are looked up in the DB.  Alternatively,
+        candidateLots may be given as a pool of Lots from this Gain's account
+        & security (e.g. as preloaded by doWashSales()) to choose from; any
+        Lots split off here get appended to it for use by subsequent Gains.
+        """
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            # Don't load the relationships just to discard them
+            logging.info('Evaluating wash sale for %s(lot=%s, transaction=%s)',
+                         self, self.lot, self.transaction)
 
         # Open Lots can't have wash sales
         if not self.lot.dtclose: 
             # This case is excluded by the doWashSales() query that normally
             # calls doWashSale()
-            logging.warn('Lot is still open: %s' % self.lot)
+            logging.warning('Lot is still open: %s', self.lot)
             return
 
         # If this Gain already has disallowed loss from a wash sale, it's
@@ -611,7 +1118,7 @@ class Gain(Base):
         if self.washloss:
             # This case is excluded by the doWashSales() query that normally
             # calls doWashSale()
-            logging.warn('Loss already disallowed: %s' % self)
+            logging.warning('Loss already disallowed: %s', self)
             return
 
         # Only realized tax losses are considered for wash sales
@@ -620,12 +1127,12 @@ class Gain(Base):
             # but the INVTRAN superclass doesn't have a total column,
             # so we handle it here
             #logging.warn('Not a loss: %s' % self)
-            logging.info('Not a loss: %s' % self)
+            logging.info('Not a loss: %s', self)
             return
 
         # To be a wash sale, this Gain must be on a trade that closed a Lot.
         if self.lot.closer != self.transaction:
-            logging.info('Not a closing transaction: %s' % self)
+            logging.info('Not a closing transaction: %s', self)
             return
 
         DBSession.add(self)
@@ -635,120 +1142,166 @@ class Gain(Base):
         # 30 days +/- the date the Gain was realized, which haven't
         # already been identified as replacement shares for another
         # wash sale)
-        replacementLots = DBSession.query(Lot).filter(
-            Lot.id != self.lot.id, 
-            Lot.account == self.lot.account,
-            Lot.security == self.lot.security,
-            Lot.units * self.units > 0,
-            Lot.washcost == 0,
-            Lot.dtopen >= self.lot.dtclose - timedelta(days=30),
-            Lot.dtopen <= self.lot.dtclose + timedelta(days=30),
-        ).order_by(Lot.dtopen)
-
-        # First tally the replacement Lots so we know how much loss to disallow
-        # FIXME we should be able to get this by SUMming the query just above
-        replacementUnits = sum([rl.units for rl in replacementLots])
+        # These queries run for every loss, so they're baked: compiled once,
+        # with only the bind parameters changing from Gain to Gain.
+        params = {
+            'lot_id': self.lot.id,
+            'acctfrom_id': self.lot.acctfrom_id,
+            'secinfo_id': self.lot.secinfo_id,
+            'units': self.units,
+            'dtmin': self.lot.dtclose - timedelta(days=30),
+            'dtmax': self.lot.dtclose + timedelta(days=30),
+        }
+
+        if candidateLots is None:
+            # First tally the replacement Lots so we know how much loss to
+            # disallow
+            bq = bakery(lambda session: session.query(func.sum(Lot.units)))
+            bq += lambda q: q.filter(*Gain.replacementCriteria())
+            replacementUnits = bq(DBSession).params(**params).scalar() \
+                    or Decimal('0')
+        else:
+            # Same criteria as replacementCriteria(), applied in Python.
+            # Lots split off since the pool was loaded haven't been flushed
+            # yet, so their washcost may still be None.
+            replacementLots = sorted(
+                [rl for rl in candidateLots
+                 if rl is not self.lot
+                 and rl.units * self.units > 0
+                 and not rl.washcost
+                 and params['dtmin'] <= rl.dtopen <= params['dtmax']],
+                key=attrgetter('dtopen'))
+            replacementUnits = sum(rl.units for rl in replacementLots)
 
         # If there are no replacement units, we can skip this whole rigmarole
         if replacementUnits == 0:
-            logging.info('No replacement units found; no wash sale: %s' % self)
+            logging.info('No replacement units found; no wash sale: %s', self)
             return
 
+        if candidateLots is None:
+            bq = bakery(lambda session: session.query(Lot))
+            bq += lambda q: q.filter(
+                *Gain.replacementCriteria()).order_by(Lot.dtopen)
+            replacementLots = bq(DBSession).params(**params).all()
+
         # Perform all calculations before altering any values on the
-        # wash sale Gain or its Lot
+        # wash sale Gain or its Lot.  Money amounts are done in floats
+        # (which are plenty precise for this) rather than Decimals;
+        # results are converted back with toDecimal() as they're stored.
+        # Units stay Decimal so that they net out to exactly zero -
+        # a float residue would get split off below as a 0-unit Lot.
+        # Per-unit amounts are computed once up front and reused below.
         lot = self.lot
+        lotUnits = lot.units
+
+        # Lots/Gains split off below; added to the session together at the end
+        created = []
+
+        # Per-unit proceeds of the transactions realizing Gains that get
+        # split below, computed once per transaction
+        transactionUnitProceeds = {}
+
+        def unitProceedsOf(transaction):
+            try:
+                return transactionUnitProceeds[transaction]
+            except KeyError:
+                unitProceeds = float(transaction.total) / -float(transaction.units)
+                transactionUnitProceeds[transaction] = unitProceeds
+                return unitProceeds
 
         # Sign-agnostic min(): take the lesser magnitude of
         # replacement units and loss units
-        replacementUnits = Decimal(math.copysign(
-            min(abs(replacementUnits), abs(lot.units)),
-            replacementUnits
-        ))
+        replacementUnits = min(
+            abs(replacementUnits), abs(lotUnits)
+        ).copy_sign(replacementUnits)
 
         washedUnits = replacementUnits
-        unwashedUnits = lot.units - washedUnits
+        unwashedUnits = lotUnits - washedUnits
 
-        washedCost = washedUnits * lot.unitCost
-        unwashedCost = unwashedUnits * lot.unitCost
+        unitCost = float(lot.cost) / float(lotUnits)
+        washedCost = float(washedUnits) * unitCost
+        unwashedCost = float(unwashedUnits) * unitCost
 
-        unitProceeds = self.proceeds / lot.units
-        washedProceeds = washedUnits * unitProceeds
-        unwashedProceeds = unwashedUnits * unitProceeds
+        unitProceeds = float(self.proceeds) / float(lotUnits)
+        washedProceeds = float(washedUnits) * unitProceeds
+        unwashedProceeds = float(unwashedUnits) * unitProceeds
 
-        unitLoss = self.value / lot.units
-        disallowedLoss = washedUnits * unitLoss
+        # Gain.value is proceeds - cost; no need for another division
+        unitLoss = unitProceeds - unitCost
+        unitWashcost = -unitLoss
+        disallowedLoss = float(washedUnits) * unitLoss
 
-        logging.info('Wash sale for %s' % self)
-        logging.info('Wash sale: units=%s, cost=%s, proceeds=%s, loss=%s' % \
-                     (washedUnits, washedCost, washedProceeds, disallowedLoss)
-                    )
-        logging.info('Not part of wash sale: units=%s, cost=%s, proceeds=%s' % \
-                     (unwashedUnits, unwashedCost, unwashedProceeds)
-                    )
+        logging.info('Wash sale for %s', self)
+        logging.info('Wash sale: units=%s, cost=%s, proceeds=%s, loss=%s',
+                     washedUnits, washedCost, washedProceeds, disallowedLoss)
+        logging.info('Not part of wash sale: units=%s, cost=%s, proceeds=%s',
+                     unwashedUnits, unwashedCost, unwashedProceeds)
 
         # Partition Gain units/cost between wash sale and excess
-        logging.info('Setting units=%s, cost=%s for %s' % \
-                     (washedUnits, washedCost, lot)
-                    )
+        logging.info('Setting units=%s, cost=%s for %s',
+                     washedUnits, washedCost, lot)
         lot.units = washedUnits
-        lot.cost = washedCost
+        lot.cost = toDecimal(washedCost)
 
         # Fix the proceeds on the wash sale Gain (i.e. self) and disallow loss
         # FIXME - it's stupid to have washloss be a Decimal if we're always
         # going to set it equal to the loss value!
-        logging.info('Setting wash sale proceeds=%s, washloss=%s for %s' % \
-                     (washedProceeds, disallowedLoss, self)
-                    )
-        self.proceeds = washedProceeds
+        logging.info('Setting wash sale proceeds=%s, washloss=%s for %s',
+                     washedProceeds, disallowedLoss, self)
+        self.proceeds = toDecimal(washedProceeds)
         try:
-            assert abs(self.value - disallowedLoss) < Decimal('0.00000001')
+            assert abs(self.value - toDecimal(disallowedLoss)) <= TOLERANCE
         except AssertionError:
             logging.critical('gain.value=%s != disallowedLoss=%s' % \
                              (self.value, disallowedLoss)
                             )
             raise
-        self.washloss = disallowedLoss
+        self.washloss = toDecimal(disallowedLoss)
 
         # If there are more loss units than replacement units, create new loss
         # Lots/Gains # to divide units/cost/proceeds between washed & unwashed.
         if unwashedUnits:
             unwashedLot = Lot(
                 account=lot.account, security=lot.security,
-                units=unwashedUnits, cost=unwashedCost,
+                units=unwashedUnits, cost=toDecimal(unwashedCost),
                 dtstart=lot.dtstart, starter=lot.starter,
                 dtend=lot.dtend, ender=lot.ender,
                 dtopen=lot.dtopen, opener=lot.opener,
                 dtclose=lot.dtclose, closer=lot.closer,
             )
-            DBSession.add(unwashedLot)
-            logging.info('Created new Lot not part of wash sale: %s' % unwashedLot)
+            created.append(unwashedLot)
+            if candidateLots is not None:
+                candidateLots.append(unwashedLot)
+            logging.info('Created new Lot not part of wash sale: %s',
+                         unwashedLot)
 
             # We also need to split any *other* Gains (i.e. other than than self)
             # on the split loss Lot
             for gain in lot.gains:
-                transaction = gain.transaction
-                proceeds = gain.units / -transaction.units * transaction.total
+                unitProceeds = unitProceedsOf(gain.transaction)
+                # All Gains on the loss Lot now have its washed units
+                proceeds = float(washedUnits) * unitProceeds
                 if gain is self:
                     # continue
                     try:
-                        assert abs(proceeds-washedProceeds)<Decimal('0.00000001')
+                        assert abs(proceeds - washedProceeds) <= TOLERANCE
                     except AssertionError:
                         logging.critical('proceeds=%s != washedProceeds=%s' % \
                                          (proceeds, washedProceeds)
                                         )
                         raise
-                gain.proceeds = proceeds
-                logging.info('Adjusted wash sale proceeds=%s for %s' % \
-                             (proceeds, gain)
-                            )
+                gain.proceeds = toDecimal(proceeds)
+                logging.info('Adjusted wash sale proceeds=%s for %s',
+                             proceeds, gain)
                 unwashedGain = Gain(
                     lot=unwashedLot,
                     transaction=gain.transaction,
                     #proceeds=unwashedLot.units / -transaction.units * transaction.total
-                    proceeds=unwashedUnits / -transaction.units * transaction.total,
+                    proceeds=toDecimal(float(unwashedUnits) * unitProceeds),
                 )
-                DBSession.add(unwashedGain)
-                logging.info('Created new Gain not part of wash sale: %s' % unwashedGain)
+                created.append(unwashedGain)
+                logging.info('Created new Gain not part of wash sale: %s',
+                             unwashedGain)
 
         # Loop through all the replacement lots, marking them with cost
         # basis adjustments as we go.  If we run out of loss units partway
@@ -758,74 +1311,81 @@ class Gain(Base):
             if replacementUnits == 0:
                 break
 
-            logging.info('%s replacement units left; applying to %s' % \
-                         (replacementUnits, lot)
-                        )
+            logging.info('%s replacement units left; applying to %s',
+                         replacementUnits, lot)
 
-            if abs(replacementUnits) >= abs(lot.units):
+            lotUnits = lot.units
+            if abs(replacementUnits) >= abs(lotUnits):
                 # More Gain units remain than replacement Lot units.
                 # Adjust the cost basis of the replacement Lot and keep going.
-                washedUnits = lot.units
+                washedUnits = lotUnits
+                washcost = float(washedUnits) * unitWashcost
 
-                lot.washcost = washedUnits * -unitLoss
-                logging.info('Rolled washcost=%s into cost basis of %s' % \
-                             (lot.washcost, lot)
-                            )
+                lot.washcost = toDecimal(washcost)
+                logging.info('Rolled washcost=%s into cost basis of %s',
+                             lot.washcost, lot)
             else:
                 # More replacement Lot units than Gain units.
                 # This is the end of the line for the loop.
                 #
                 # Perform all calculations before altering any values on the
                 # replacement Gain or its Lot
+                unitCost = float(lot.cost) / float(lotUnits)
                 washedUnits = replacementUnits
-                washedCost = washedUnits * lot.unitCost
-                unwashedUnits = lot.units - washedUnits
-                unwashedCost = unwashedUnits * lot.unitCost
+                washedCost = float(washedUnits) * unitCost
+                unwashedUnits = lotUnits - washedUnits
+                unwashedCost = float(unwashedUnits) * unitCost
+                washcost = float(washedUnits) * unitWashcost
 
                 # Split the replacement Lot into washed/unwashed.
                 # Adjust the cost basis of the washed replacement Lot.
                 # Allocate replacement Lot cost basis proportionately
                 # between washed & unwashed replacement Lots.
                 lot.units = washedUnits
-                lot.cost = washedCost
-                lot.washcost = washedUnits * -unitLoss
-                logging.info('Segregated replacement shares; units=%s, cost=%s; rolled washcost=%s into cost basis of %s' % (washedUnits, washedCost, lot.washcost, lot)
-                            )
+                lot.cost = toDecimal(washedCost)
+                lot.washcost = toDecimal(washcost)
+                logging.info('Segregated replacement shares; units=%s, cost=%s; rolled washcost=%s into cost basis of %s',
+                             washedUnits, washedCost, lot.washcost, lot)
 
                 unwashedLot = Lot(
                     account=lot.account, security=lot.security,
-                    units=unwashedUnits, cost=unwashedCost,
+                    units=unwashedUnits,
+                    cost=toDecimal(unwashedCost),
                     dtstart=lot.dtstart, starter=lot.starter,
                     dtend=lot.dtend, ender=lot.ender,
                     dtopen=lot.dtopen, opener=lot.opener,
                     dtclose=lot.dtclose, closer=lot.closer,
                 )
-                DBSession.add(unwashedLot)
-                logging.info('Segregated non-replacement shares; units=%s, cost=%s: %s' % \
-                             (unwashedLot.units, unwashedLot.cost, lot)
-                            )
+                created.append(unwashedLot)
+                if candidateLots is not None:
+                    candidateLots.append(unwashedLot)
+                logging.info('Segregated non-replacement shares; units=%s, cost=%s: %s',
+                             unwashedLot.units, unwashedLot.cost, lot)
 
                 # If the replacement Lot has Gains, those also need to be
                 # split between washed & unwashed Lots with proceeds allocated
                 # proportionately.
                 for gain in lot.gains:
-                    transaction = gain.transaction
-                    gain.proceeds = gain.units / -transaction.units * transaction.total
-                    logging.info('Gain on replacement Lot: adjusted proceeds=%s on replacement units: %s' % (gain.proceeds, gain)
-                                )
+                    unitProceeds = unitProceedsOf(gain.transaction)
+                    gain.proceeds = toDecimal(float(washedUnits) * unitProceeds)
+                    logging.info('Gain on replacement Lot: adjusted proceeds=%s on replacement units: %s',
+                                 gain.proceeds, gain)
                     unwashedGain = Gain(
                         lot=unwashedLot,
                         transaction=gain.transaction,
-                        proceeds=unwashedLot.units / -transaction.units * transaction.total
+                        proceeds=toDecimal(float(unwashedUnits) * unitProceeds)
                     )
-                    DBSession.add(unwashedGain)
-                    logging.info('Segregated proceeds=%s as Gain on non-replacement units: %s' % (unwashedGain.proceeds, unwashedGain))
+                    created.append(unwashedGain)
+                    logging.info('Segregated proceeds=%s as Gain on non-replacement units: %s',
+                                 unwashedGain.proceeds, unwashedGain)
 
             replacementUnits -= washedUnits
-            disallowedLoss += lot.washcost
+            disallowedLoss += washcost
 
-        assert replacementUnits == Decimal('0')
-        assert disallowedLoss == Decimal('0')
+        DBSession.add_all(created)
+
+        assert replacementUnits == 0
+        assert abs(disallowedLoss) <= TOLERANCE
 
     csvFields = ('brokerid', 'acctid', 'ticker', 'secname', 'dtclose',
                  'fitidclose', 'longterm', 'dtopen', 'fitidopen', 'units',
@@ -836,66 +1396,64 @@ class Gain(Base):
         """ """
         dtstart = dtstart or datetime.min
         dtend = dtend or datetime.max
-        with open(csvfile, 'w') as csvfile:
-            csvwriter = csv.DictWriter(csvfile, cls.csvFields, delimiter=',')
-            csvwriter.writeheader()
-
-            gains = DBSession.query(cls).filter(
-                cls.invtran_id == INVTRAN.id,
-                INVTRAN.dttrade >= dtstart,
-                INVTRAN.dttrade <= dtend,
-            )
+        with open(csvfile, 'w', buffering=CSV_BUFFERSIZE) as csvfile:
+            csvwriter = csv.writer(csvfile, delimiter=',')
+            csvwriter.writerow(cls.csvFields)
+
+            gains = DBSession.query(cls).join(cls.transaction).join(
+                cls.lot).filter(
+                    INVTRAN.dttrade >= dtstart,
+                    INVTRAN.dttrade <= dtend,
+                )
             if account:
-                lots = lots.filter_by(account=account)
+                gains = gains.filter(Lot.acctfrom_id == account.id)
             if security:
-                lots = lots.filter_by(security=security)
+                gains = gains.filter(Lot.secinfo_id == security.id)
 
             if consolidate:
                 # Consolidate Gains by account/secinfo, 
-                # disregarding dtopen/dtclose
-                p = defaultdict(list)
-                for gain in gains:
-                    p[(gain.lot.account, gain.lot.security)].append((gain.units, gain.proceeds, gain.cost, gain.value, gain.washcost, gain.washloss))
-                for (account, secinfo), gains in p.items():
-                    secgain = {'brokerid': account.brokerid,
-                               'acctid': account.acctid,
-                               'ticker': secinfo.ticker,
-                               'secname': secinfo.secname,
-                               'units': sum([g[0] for g in gains]),
-                               'proceeds': sum([g[1] for g in gains]),
-                               'cost': sum([g[2] for g in gains]),
-                               'gain': sum([g[3] for g in gains]),
-                               'washcost': sum([g[4] for g in gains]),
-                               'washloss': sum([g[5] for g in gains]),
-                              }
-                    csvwriter.writerow(secgain)
+                # disregarding dtopen/dtclose.  The DB does the sums.
+                totals = gains.with_entities(
+                    INVACCTFROM.brokerid, INVACCTFROM.acctid,
+                    SECINFO.ticker, SECINFO.secname,
+                    func.sum(Lot.units), func.sum(cls.proceeds),
+                    func.sum(Lot.cost), func.sum(cls.proceeds - Lot.cost),
+                    func.sum(Lot.washcost), func.sum(cls.washloss),
+                ).join(Lot.account).join(Lot.security).group_by(
+                    INVACCTFROM.id, INVACCTFROM.brokerid, INVACCTFROM.acctid,
+                    SECINFO.id, SECINFO.ticker, SECINFO.secname,
+                )
+                csvwriter.writerows(
+                    (brokerid, acctid, ticker, secname,
+                     None, None, None, None, None) + tuple(sums)
+                    for (brokerid, acctid, ticker, secname, *sums) in totals)
             else:
-                for gain in gains:
-                    lot = gain.lot
-                    account = lot.account
-                    secinfo = lot.security
-                    opener = lot.opener
-
-                    if opener:
-                        fitidopen = opener.fitid
-                    else:
-                        fitidopen = None
-
-                    if gain.isLongTerm:
-                        longterm = 'LTCG'
-                    else:
-                        longterm = 'STCG'
-                    g = {'brokerid': account.brokerid, 'acctid': account.acctid,
-                         'ticker': secinfo.ticker, 'secname': secinfo.secname,
-                         'dtclose': gain.dtclose,
-                         'fitidclose': gain.transaction.fitid,
-                         'dtopen': gain.dtopen, 'fitidopen': fitidopen,
-                         'longterm': longterm,
-                         'units': gain.units, 'proceeds': gain.proceeds,
-                         'cost': gain.cost, 'gain': gain.value,
-                         'washcost': gain.washcost, 'washloss': gain.washloss,
-                        }
-                    csvwriter.writerow(g)
+                # No Gain instances are needed, just column values, so
+                # execute the SELECT directly and stream out the raw rows
+                # (server-side cursor where the driver supports it).
+                opener = aliased(INVTRAN)
+                longterm = case(
+                    [(and_(Lot.units > 0,
+                           daysBetween(Lot.dtopen, INVTRAN.dttrade) > 365),
+                      'LTCG')],
+                    else_='STCG')
+                # Columns are labeled with their csvFields names
+                columns = (
+                    INVACCTFROM.brokerid, INVACCTFROM.acctid,
+                    SECINFO.ticker, SECINFO.secname,
+                    INVTRAN.dttrade, INVTRAN.fitid, longterm,
+                    Lot.dtopen, opener.fitid,
+                    Lot.units, cls.proceeds, Lot.cost,
+                    cls.proceeds - Lot.cost,
+                    Lot.washcost, cls.washloss,
+                )
+                rows = gains.with_entities(*[
+                    column.label(field)
+                    for column, field in zip(columns, cls.csvFields)
+                ]).join(Lot.account).join(Lot.security).outerjoin(
+                    opener, Lot.opener_id == opener.id
+                ).statement.execution_options(stream_results=True)
+                csvwriter.writerows(DBSession.execute(rows))
 
 
 class OfxLog(Base):
@@ -906,27 +1464,75 @@ class OfxLog(Base):
         , unique=True)
     invtran = relationship('INVTRAN')
 
+    # Key in Session.info for the cache kept by processedIds()
+    infoKey = 'capgains.ofxlog'
+
+    @classmethod
+    def processedIds(cls, DBSession):
+        """
+        Map the ids of the INVTRANs that have been logged as processed to
+        the ids of their OfxLogs (None until the OfxLog has been flushed).
+        It's loaded with a single SELECT the first time it's needed, then
+        kept up to date in DBSession.info (and discarded on rollback).
+        """
+        try:
+            return DBSession.info[cls.infoKey]
+        except KeyError:
+            ids = dict(DBSession.query(cls.invtran_id, cls.id))
+            DBSession.info[cls.infoKey] = ids
+            return ids
+
     @classmethod
     def get_or_create(cls, DBSession, invtran):
-        """ """
-        t = DBSession.query(cls).filter_by(invtran=invtran).one_or_none()
-        if t:
-            created = False
-        else:
-            t = cls(invtran=invtran)
-            DBSession.add(t)
-            created = True
-        return t, created
+        """
+        Log invtran as processed, unless it's already been logged.
+
+        Returns (OfxLog, created).  Neither path SELECTs by invtran: a new
+        OfxLog is just added to the session, and an existing one is fetched
+        by primary key (straight from the identity map if it's loaded).
+        """
+        processed = cls.processedIds(DBSession)
+        if invtran.id is None:
+            DBSession.flush()
+        if invtran.id in processed:
+            if processed[invtran.id] is None:
+                # Logged earlier in this session; flushing assigns its id
+                DBSession.flush()
+            return DBSession.query(cls).get(processed[invtran.id]), False
+        t = cls(invtran=invtran)
+        DBSession.add(t)
+        processed[invtran.id] = None
+        return t, True
+
+
+@event.listens_for(OfxLog, 'after_insert')
+def _addProcessedId(mapper, connection, target):
+    """ Keep the processedIds() cache current for OfxLogs as they're flushed """
+    ids = object_session(target).info.get(OfxLog.infoKey)
+    if ids is not None:
+        ids[target.invtran_id] = target.id
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_soft_rollback')
+def _discardProcessedIds(session, previous_transaction):
+    """
+    OfxLogs (and INVTRANs) added since the last commit are gone; so are the
+    caches that may refer to them
+    """
+    session.info.pop(OfxLog.infoKey, None)
+    session.info.pop(IBKR.infoKey, None)
 
 
 class IBKR(object):
-    transferMemoRE = re.compile(
-        r"""
-        (?P<memo>.+)
-        \s+
-        \( (?P<ticker>.+), \s+ (?P<secname>.+), \s+ (?P<uniqueid>[\w]+) \)
-        """, re.VERBOSE | re.IGNORECASE
-    )
+    # TRANSFER memos end with "(<ticker>, <secname>, <uniqueid>)", where the
+    # memo before it and the secname may both contain commas & parentheses
+    # (e.g. "ABC(123) MERGED (DEF, DEF CORP (NEW), 987654321)").  Rather
+    # than one regex with open-ended groups (which backtracks polynomially
+    # on memos that don't match), parseTransferMemo() looks for the opening
+    # and closing of that part separately with these patterns, which can't
+    # overlap themselves, so each is a single linear scan.
+    transferOpeningRE = re.compile(r'\s\((?P<ticker>[^,()]+),\s+')
+    transferClosingRE = re.compile(r',\s+(?P<uniqueid>\w+)\)')
 
     retofcapMemoRE = re.compile(
         r"""
@@ -936,6 +1542,56 @@ class IBKR(object):
         """, re.VERBOSE | re.IGNORECASE
     )
 
+    @classmethod
+    def parseTransferMemo(cls, memo):
+        """
+        Split a TRANSFER memo into (memo, ticker, secname, uniqueid), or
+        return None if it isn't in that format.  The uniqueid is taken from
+        the last ", <uniqueid>)" in the memo, and the ticker from the last
+        " (<ticker>, " before that; anything after the closing parenthesis
+        is ignored.
+        """
+        closing = None
+        for closing in cls.transferClosingRE.finditer(memo):
+            pass
+        if closing is None:
+            return None
+        opening = None
+        for opening in cls.transferOpeningRE.finditer(memo, 0,
+                                                      closing.start()):
+            pass
+        if opening is None:
+            return None
+        head = memo[:opening.start()].rstrip()
+        secname = memo[opening.end():closing.start()]
+        if not head or not secname:
+            return None
+        return (head, opening.group('ticker'), secname,
+                closing.group('uniqueid'))
+
+    # DBSession.info key for candidates() results
+    infoKey = 'capgains.ibkr.candidates'
+
+    @staticmethod
+    def candidates(DBSession, model, **key):
+        """
+        Instances of model (in id order) whose attributes equal key.
+
+        Matching TRANSFER/INVEXPENSE memos is a prefix match, which can't
+        use an index; instead the candidates are looked up by exact key
+        here and their memos compared in Python.  Results are cached in
+        DBSession.info until the next commit or rollback.
+        """
+        cache = DBSession.info.setdefault(IBKR.infoKey, {})
+        cacheKey = (model, tuple(sorted(key.items())))
+        try:
+            return cache[cacheKey]
+        except KeyError:
+            instances = DBSession.query(model).filter_by(**key).order_by(
+                model.id).all()
+            cache[cacheKey] = instances
+            return instances
+
     @classmethod
     def doTransfer(cls, DBSession, invtran):
         """ """
@@ -950,18 +1606,24 @@ class IBKR(object):
             return
         
 
-        match = cls.transferMemoRE.match(invtran.memo)
-        # Sanity check memo regex match
-        assert match
-        #assert match.group('ticker') == invtran.secinfo.ticker
-        assert match.group('uniqueid') == invtran.secinfo.uniqueid
-        memo = match.group('memo')
+        parsed = cls.parseTransferMemo(invtran.memo)
+        # Sanity check memo format
+        assert parsed
+        memo, ticker, secname, uniqueid = parsed
+        #assert ticker == invtran.secinfo.ticker
+        assert uniqueid == invtran.secinfo.uniqueid
         assert memo
 
-        twin = DBSession.query(TRANSFER).filter(
-            TRANSFER.id != invtran.id, TRANSFER.acctfrom == invtran.acctfrom,
-            TRANSFER.dttrade == invtran.dttrade, TRANSFER.memo.like(memo+'%'),
-        ).one_or_none()
+        twins = [
+            transfer for transfer in cls.candidates(
+                DBSession, TRANSFER, acctfrom_id=invtran.acctfrom_id,
+                dttrade=invtran.dttrade)
+            if transfer is not invtran
+            and (transfer.memo or '').startswith(memo)
+        ]
+        if len(twins) > 1:
+            raise MultipleResultsFound('Multiple TRANSFERs match %s' % invtran)
+        twin = twins[0] if twins else None
 
         if twin:
             t, created = OfxLog.get_or_create(DBSession, twin) 
@@ -970,26 +1632,34 @@ class IBKR(object):
             assert invtran.units * twin.units < 0
 
             # Which TRANSFER (passed in or looked-up twin) corresponds to
-            # a security for which we already own Lots?
+            # a security for which we already own Lots?  Fetch the Lots for
+            # both sides of the pair at once.
+            # Total units per security are tallied in the same pass.
+            held = defaultdict(list)
+            heldUnits = defaultdict(Decimal)
+            for lot in DBSession.query(Lot).filter(
+                *Lot.asOfCriteria(invtran.dttrade, account=invtran.acctfrom),
+                Lot.secinfo_id.in_([invtran.secinfo_id, twin.secinfo_id])
+            ).order_by(Lot.dtopen, Lot.id):
+                held[lot.secinfo_id].append(lot)
+                heldUnits[lot.secinfo_id] += lot.units
+
             security = invtran.secinfo
-            lots = Lot.asOf(DBSession, invtran.dttrade,
-                            account=invtran.acctfrom, security=security).all()
+            lots = held[invtran.secinfo_id]
 
-            if lots and invtran.units == -sum([lot.units for lot in lots]):
-                units = sum([lot.units for lot in lots])
+            units = heldUnits[invtran.secinfo_id]
+            if lots and invtran.units == -units:
                 transferOut, transferIn = invtran, twin
                 newSecurity = twin.secinfo
             else:
                 # Do we own the looked-up twin TRANSFER?
                 newSecurity = invtran.secinfo 
                 security = twin.secinfo
-                lots = Lot.asOf(DBSession, invtran.dttrade,
-                                account=invtran.acctfrom, security=security
-                               ).all()
+                lots = held[twin.secinfo_id]
                 if not lots:
                     # We don't own either side of the pair; ignore it
                     return
-                units = sum([lot.units for lot in lots])
+                units = heldUnits[twin.secinfo_id]
                 try:
                     assert units == -twin.units
                 except AssertionError:
@@ -1029,7 +1699,7 @@ class IBKR(object):
             return
         match = cls.retofcapMemoRE.match(invtran.memo)
         assert match
-        memo = match.group('memo')
+        memo = match.group(1)
 
         # Before changing Lot cost basis, check to see that the return of
         # capital hasn't been reversed - this happens often as the broker
@@ -1038,11 +1708,12 @@ class IBKR(object):
         #
         # INCOME transactions get reversed as INVEXPENSE, so check those
         # for matching date/total/memo.
-        reversal = DBSession.query(INVEXPENSE).filter(
-            INVEXPENSE.dttrade == invtran.dttrade,
-            INVEXPENSE.total == -invtran.total,
-            INVEXPENSE.memo.like(memo+'%'),
-        ).order_by(INVEXPENSE.id).first()
+        reversal = next((
+            expense for expense in cls.candidates(
+                DBSession, INVEXPENSE, dttrade=invtran.dttrade,
+                total=-invtran.total)
+            if (expense.memo or '').startswith(memo)
+        ), None)
         if reversal:
             t, created = OfxLog.get_or_create(DBSession, reversal)
             return
@@ -1054,11 +1725,71 @@ class IBKR(object):
         Lot.returnOfCapital(DBSession, invtran, checklog=False)
 
 
+@event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _discardIbkrCandidates(session):
+    """ Committed instances get expired; look IBKR candidates up afresh """
+    session.info.pop(IBKR.infoKey, None)
+
+
 brokerquirks = {
     '4705': {TRANSFER: IBKR.doTransfer, INCOME: IBKR.doIncome,},
 }
 
 
+# Default handlers, looked up along the INVTRAN subclass's MRO
+# (e.g. BUYSTOCK -> INVBUYSELL)
+invtranHandlers = {
+    INVBUYSELL: Lot.trade,
+    RETOFCAP: Lot.returnOfCapital,
+    SPLIT: Lot.split,
+}
+
+
+def resolveHandler(brokerid, invtranType):
+    """
+    Look up the method that processes INVTRANs of the given type for the
+    given broker (or None if they're ignored) in brokerquirks, falling back
+    to invtranHandlers.
+    """
+    handler = brokerquirks.get(brokerid, {}).get(invtranType, None)
+    if handler is None:
+        handler = next((invtranHandlers[c] for c in invtranType.__mro__
+                        if c in invtranHandlers), None)
+    return handler
+
+
+# Resolved handlers keyed by (brokerid, INVTRAN subclass), for every broker
+# with quirks plus brokerid None for everyone else.  Built at import time;
+# call rebuildHandlerTable() after changing brokerquirks or invtranHandlers.
+handlerTable = {}
+
+
+def rebuildHandlerTable():
+    """ (Re)fill handlerTable from brokerquirks & invtranHandlers """
+    handlerTable.clear()
+    for mapper in INVTRAN.__mapper__.self_and_descendants:
+        invtranType = mapper.class_
+        for brokerid in [None] + list(brokerquirks):
+            handlerTable[(brokerid, invtranType)] = resolveHandler(
+                brokerid, invtranType)
+
+
+rebuildHandlerTable()
+
+
+def invtranHandler(brokerid, invtranType):
+    """
+    Return the method that processes INVTRANs of the given type for the
+    given broker (or None if they're ignored).
+    """
+    key = (brokerid if brokerid in brokerquirks else None, invtranType)
+    try:
+        return handlerTable[key]
+    except KeyError:
+        # Not a mapped INVTRAN subclass
+        return resolveHandler(brokerid, invtranType)
+
+
 @contextmanager
 def session_scope(database):
     """
@@ -1075,11 +1806,53 @@ def session_scope(database):
         session.close()
 
 
+# psycopg2's fast execution helpers send the executemany() INSERTs emitted
+# when the ORM flushes Lots/Gains as multi-row statements instead of one
+# round trip per row; doInvtrans() needs them to scale on PostgreSQL.
+PSYCOPG2_ENGINE_OPTIONS = {
+    'executemany_mode': 'values',
+    'executemany_values_page_size': 1000,
+    'executemany_batch_page_size': 500,
+}
+
+
+# sessionmakers by database URL, so that the engine (with its connection
+# pool) is created, and the schema checked, only once per process.
+_sessionmakers = {}
+
+
+def createMissingIndexes(engine):
+    """
+    create_all() only creates indexes along with their tables, so a DB
+    created by an earlier version lacks any indexes declared since; add them.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info('Creating index %s', index.name)
+                index.create(engine)
+
+
 def Session(database):
-    engine = sqlalchemy.create_engine(database)
-    ofxalchemy.models.Base.metadata.create_all(engine)
-    Base.metadata.create_all(engine)
-    return sqlalchemy.orm.sessionmaker(bind=engine)()
+    try:
+        sessionmaker = _sessionmakers[database]
+    except KeyError:
+        options = {}
+        url = sqlalchemy.engine.url.make_url(database)
+        if url.get_dialect().driver == 'psycopg2':
+            options.update(PSYCOPG2_ENGINE_OPTIONS)
+        engine = sqlalchemy.create_engine(database, **options)
+        # Base shares ofxalchemy's MetaData; one pass creates both
+        Base.metadata.create_all(engine)
+        createMissingIndexes(engine)
+        sessionmaker = sqlalchemy.orm.sessionmaker(bind=engine)
+        _sessionmakers[database] = sessionmaker
+    return sessionmaker()
 
 
 def ofximport(args):
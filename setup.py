@@ -53,7 +53,7 @@ setup(
 
     install_requires = [
         'ofxtools >= 0.3.13',
-        'sqlalchemy >= 1.0.0',
+        'sqlalchemy >= 1.3.7',
     ],
 
     package_data = {
@@ -10,16 +10,18 @@ from operator import attrgetter
 
 
 # 3rd party imports
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, contains_eager
+from sqlalchemy.pool import StaticPool
 
-from ofxtools import ofxalchemy
 from ofxtools.ofxalchemy.models import (
     INVACCTFROM,
     STOCKINFO,
     INVTRAN,
     BUYSTOCK,
     SELLSTOCK,
+    TRANSFER,
+    INCOME,
 )
 
 
@@ -28,13 +30,52 @@ from capgains.models import (
     Base,
     Lot,
     OfxLog,
+    IBKR,
+    parseCsvDatetime,
+    createMissingIndexes,
+    brokerquirks,
+    invtranHandler,
+    rebuildHandlerTable,
 )
 
 
 ### DB SETUP
-dbfile = 'test.db'
-engine = create_engine('sqlite:///%s' % dbfile, echo=False)
-Session = sessionmaker(bind=engine)
+# One in-memory DB per process (so per pytest-xdist worker), shared by every
+# connection via StaticPool.
+# pytest-xdist workers run concurrently; give each its own CSV file.
+worker = os.environ.get('PYTEST_XDIST_WORKER', 'gw0')
+csvfile = 'test-%s.csv' % worker
+engine = create_engine('sqlite://', echo=False,
+                       connect_args={'check_same_thread': False},
+                       poolclass=StaticPool)
+Session = sessionmaker(expire_on_commit=False)
+
+# pysqlite's own transaction handling doesn't play well with SAVEPOINT;
+# take it over so each test can run in one that gets rolled back.
+@event.listens_for(engine, 'connect')
+def _disablePysqliteBegin(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, 'begin')
+def _emitBegin(conn):
+    conn.execute('BEGIN')
+
+# Durability doesn't matter for a test DB.  (An in-memory DB keeps its
+# journal in memory already; temp tables & sort spills should too.)
+@event.listens_for(engine, 'connect')
+def _setPragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+def setUpModule():
+    # capgains models share ofxalchemy's MetaData; one pass creates both
+    Base.metadata.create_all(engine)
+
+def tearDownModule():
+    Base.metadata.drop_all(engine)
+    engine.dispose()
 
 @contextmanager
 def session_scope():
@@ -51,49 +92,100 @@ def session_scope():
     finally:
         session.close()
 
-class LotTestCase(unittest.TestCase):
+class AlchemyTestCase(unittest.TestCase):
+    """
+    Tests share one connection per class, inside a transaction that's rolled
+    back at the end.  Each test runs in a SAVEPOINT that tearDown() rolls
+    back; Session commits within it never reach the DB.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = engine.connect()
+        cls.transaction = cls.connection.begin()
+        Session.configure(bind=cls.connection)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.transaction.rollback()
+        cls.connection.close()
+
     def setUp(self):
-        ofxalchemy.models.Base.metadata.create_all(engine)
-        Base.metadata.create_all(engine)
+        self.savepoint = self.connection.begin_nested()
+
+    def tearDown(self):
+        self.savepoint.rollback()
 
-        self.acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
+
+class LotTestCase(AlchemyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(LotTestCase, cls).setUpClass()
+
+        # Parse fixture values once; setUp() only instantiates models
+        cls._acctfrom_kwargs = dict(brokerid='2222', acctid='271828')
 
         # Buy BKRA and leave it open
-        self.secinfo1 = STOCKINFO(uniqueidtype='CUSIP', uniqueid='084670108',
-                                ticker='BRK-A',secname='Berkshire Hathaway')
-        self.invtran1 = BUYSTOCK(
-            acctfrom=self.acctfrom,
+        cls._secinfo1_kwargs = dict(
+            uniqueidtype='CUSIP', uniqueid='084670108',
+            ticker='BRK-A', secname='Berkshire Hathaway')
+        cls._invtran1_kwargs = dict(
             fitid='a', dttrade=datetime(2016, 1, 4, 9, 30),
-            buytype='BUY', secinfo=self.secinfo1,
+            buytype='BUY',
             units=Decimal('1'), unitprice=Decimal('193300'),
             commission=Decimal('9.99'), total=Decimal('-193309.99'),
             subacctsec='CASH', subacctfund='CASH'
         )
-        self.brkaLot = Lot(security=self.secinfo1, account=self.acctfrom,
-                           dtopen=self.invtran1.dttrade, opener=self.invtran1,
-                           dtstart=self.invtran1.dttrade, starter=self.invtran1,
-                           units=self.invtran1.units, cost=-self.invtran1.total,
-                          )
-        
+
         # Buy IBKR then close it
-        self.secinfo2 = STOCKINFO(uniqueidtype='CUSIP', uniqueid='45841N107',
-                                ticker='IBKR',secname='Interactive Brokers')
-        self.invtran2 = BUYSTOCK(
-            acctfrom=self.acctfrom,
+        cls._secinfo2_kwargs = dict(
+            uniqueidtype='CUSIP', uniqueid='45841N107',
+            ticker='IBKR', secname='Interactive Brokers')
+        cls._invtran2_kwargs = dict(
             fitid='b', dttrade=datetime(2016, 1, 4, 12, 45),
-            buytype='BUY', secinfo=self.secinfo2,
+            buytype='BUY',
             units=Decimal('100'), unitprice=Decimal('42.24'),
             commission=Decimal('9.99'), total=Decimal('-4233.99'),
             subacctsec='CASH', subacctfund='CASH'
         )
-        self.invtran3 = SELLSTOCK(
-            acctfrom=self.acctfrom,
+        cls._invtran3_kwargs = dict(
             fitid='c', dttrade=datetime(2016, 1, 10, 10, 15),
-            selltype='SELL', secinfo=self.secinfo2,
+            selltype='SELL',
             units=Decimal('-100'), unitprice=Decimal('43.35'),
             commission=Decimal('9.99'), total=Decimal('4325.01'),
             subacctsec='CASH', subacctfund='CASH'
         )
+
+        # Sell KMI short and leave it open
+        cls._secinfo3_kwargs = dict(
+            uniqueidtype='CUSIP', uniqueid='49456B101',
+            ticker='KMI', secname='Kinder Morgan')
+        cls._invtran4_kwargs = dict(
+            fitid='d', dttrade=datetime(2016, 1, 4, 9, 30),
+            selltype='SELL',
+            units=Decimal('-100'), unitprice=Decimal('18.25'),
+            commission=Decimal('9.99'), total=Decimal('1815.01'),
+            subacctsec='CASH', subacctfund='CASH'
+        )
+
+    def setUp(self):
+        super(LotTestCase, self).setUp()
+
+        self.acctfrom = INVACCTFROM(**self._acctfrom_kwargs)
+
+        self.secinfo1 = STOCKINFO(**self._secinfo1_kwargs)
+        self.invtran1 = BUYSTOCK(acctfrom=self.acctfrom, secinfo=self.secinfo1,
+                                 **self._invtran1_kwargs)
+        self.brkaLot = Lot(security=self.secinfo1, account=self.acctfrom,
+                           dtopen=self.invtran1.dttrade, opener=self.invtran1,
+                           dtstart=self.invtran1.dttrade, starter=self.invtran1,
+                           units=self.invtran1.units, cost=-self.invtran1.total,
+                          )
+
+        self.secinfo2 = STOCKINFO(**self._secinfo2_kwargs)
+        self.invtran2 = BUYSTOCK(acctfrom=self.acctfrom, secinfo=self.secinfo2,
+                                 **self._invtran2_kwargs)
+        self.invtran3 = SELLSTOCK(acctfrom=self.acctfrom, secinfo=self.secinfo2,
+                                  **self._invtran3_kwargs)
         self.ibkrLot = Lot(security=self.secinfo2, account=self.acctfrom,
                            units=self.invtran2.units, cost=-self.invtran2.total,
                            dtopen=self.invtran2.dttrade, opener=self.invtran2,
@@ -102,29 +194,24 @@ class LotTestCase(unittest.TestCase):
                            dtend=self.invtran3.dttrade, ender=self.invtran3,
                           )
 
-        # Sell KMI short and leave it open
-        self.secinfo3 = STOCKINFO(uniqueidtype='CUSIP', uniqueid='49456B101',
-                                  ticker='KMI', secname='Kinder Morgan')
-        self.invtran4 = SELLSTOCK(
-            acctfrom=self.acctfrom,
-            fitid='d', dttrade=datetime(2016, 1, 4, 9, 30),
-            selltype='SELL', secinfo=self.secinfo3,
-            units=Decimal('-100'), unitprice=Decimal('18.25'),
-            commission=Decimal('9.99'), total=Decimal('1815.01'),
-            subacctsec='CASH', subacctfund='CASH'
-        )
+        self.secinfo3 = STOCKINFO(**self._secinfo3_kwargs)
+        self.invtran4 = SELLSTOCK(acctfrom=self.acctfrom, secinfo=self.secinfo3,
+                                  **self._invtran4_kwargs)
         self.kmiLot = Lot(security=self.secinfo3, account=self.acctfrom,
                           dtopen=self.invtran4.dttrade, opener=self.invtran4,
                           dtstart=self.invtran4.dttrade, starter=self.invtran4,
                           units=self.invtran4.units, cost=-self.invtran4.total,
                          )
 
-    def tearDown(self):
-        pass
-        try:
-            os.unlink(dbfile)
-        except OSError:  # file not created by test -- probably an error
-            pass
+    def testParseCsvDatetime(self):
+        self.assertEqual(parseCsvDatetime('2015-12-09'), datetime(2015, 12, 9))
+        self.assertEqual(parseCsvDatetime('2015-1-5'), datetime(2015, 1, 5))
+        self.assertEqual(parseCsvDatetime('2015-12-09 09:30:00'),
+                         datetime(2015, 12, 9, 9, 30))
+        self.assertEqual(parseCsvDatetime('2015-1-5 9:30:0'),
+                         datetime(2015, 1, 5, 9, 30))
+        self.assertEqual(parseCsvDatetime('December 09, 2015'),
+                         datetime(2015, 12, 9))
 
     def testLotUnitCost(self):
         with session_scope() as DBSession:
@@ -133,23 +220,13 @@ class LotTestCase(unittest.TestCase):
 
     def testLotAsOf(self):
         with session_scope() as DBSession:
-            # BRK buy
-            DBSession.add(self.invtran1)
-            DBSession.add(self.brkaLot)
-
-            # IBKR buy
-            DBSession.add(self.invtran2)
-            DBSession.add(self.ibkrLot)
-
+            # BRK buy, IBKR buy, KMI short.
             # Mock IBKR Lot being closed by self.invtran3
-            DBSession.add(self.invtran3)
             self.ibkrLot.dtclose = self.invtran3.dttrade
             self.ibkrLot.dtend = self.invtran3.dttrade
-            DBSession.add(self.ibkrLot)
-
-            # Create KMI short
-            DBSession.add(self.invtran4)
-            DBSession.add(self.kmiLot)
+            DBSession.add_all([self.invtran1, self.brkaLot,
+                               self.invtran2, self.ibkrLot, self.invtran3,
+                               self.invtran4, self.kmiLot])
 
             # Before the first INVTRAN there should be no Lots
             self.assertEqual(Lot.asOf(DBSession, datetime(2015,1,1)).all(), [])
@@ -181,20 +258,17 @@ class LotTestCase(unittest.TestCase):
     def testLotLongsAsOf(self):
         with session_scope() as DBSession:
             # Mock IBKR Lot being closed by self.invtran3
-            DBSession.add(self.invtran3)
             self.ibkrLot.dtclose = self.invtran3.dttrade
-            DBSession.add(self.ibkrLot)
+            DBSession.add_all([self.invtran1, self.brkaLot,
+                               self.invtran2, self.ibkrLot, self.invtran3,
+                               self.invtran4, self.kmiLot])
 
             # Before the first INVTRAN there should be no Lots
             self.assertEqual(Lot.longsAsOf(DBSession, datetime(2015,1,1)).all(),
                              [])
-            DBSession.add(self.invtran4)
-            DBSession.add(self.kmiLot)
 
             # At moment of the BRKA purchase, that should be the only long Lot
             # (KMI transaction is simultaneous, but it's a short sale)
-            DBSession.add(self.invtran1)
-            DBSession.add(self.brkaLot)
             lots = Lot.longsAsOf(DBSession, self.invtran1.dttrade).all()
             self.assertEqual(len(lots), 1)
             self.assertIs(lots[0], self.brkaLot)
@@ -202,8 +276,6 @@ class LotTestCase(unittest.TestCase):
             # At the moment of the IBKR purchase, there should be two Lots 
             # (BRKA & IBKR).  They should be returned in chronological order
             # by purchase date.
-            DBSession.add(self.invtran2)
-            DBSession.add(self.ibkrLot)
             lots = Lot.longsAsOf(DBSession, self.invtran2.dttrade).all()
             self.assertEqual(len(lots), 2)
             self.assertIs(lots[0], self.brkaLot)
@@ -215,11 +287,86 @@ class LotTestCase(unittest.TestCase):
             self.assertEqual(len(lots), 1)
             self.assertIs(lots[0], self.brkaLot)
 
+    def testLotAsOfEagerLoads(self):
+        """ asOf() loads Lot.account/Lot.security without a SELECT per Lot """
+        dtasof = self.invtran2.dttrade
+        with session_scope() as DBSession:
+            DBSession.add_all([self.brkaLot, self.ibkrLot, self.kmiLot])
+
+        queries = []
+        def countQuery(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        # Start from an empty identity map so the relationships must be loaded
+        with session_scope() as DBSession:
+            event.listen(engine, 'before_cursor_execute', countQuery)
+            try:
+                lots = Lot.asOf(DBSession, dtasof).all()
+                self.assertEqual(len(lots), 3)
+                for lot in lots:
+                    lot.account.acctid
+                    lot.security.ticker
+            finally:
+                event.remove(engine, 'before_cursor_execute', countQuery)
+            # Lots, then one SELECT apiece for accounts & securities
+            self.assertEqual(len(queries), 3)
+
+    def testLotBakedAsOf(self):
+        """ _bakedAsOf() returns the same Lots as asOf()/longsAsOf() """
+        with session_scope() as DBSession:
+            self.ibkrLot.dtclose = self.invtran3.dttrade
+            self.ibkrLot.dtend = self.invtran3.dttrade
+            DBSession.add_all([self.invtran1, self.brkaLot,
+                               self.invtran2, self.ibkrLot, self.invtran3,
+                               self.invtran4, self.kmiLot])
+            DBSession.flush()
+
+            for dtasof in (datetime(2015, 1, 1), self.invtran1.dttrade,
+                           self.invtran2.dttrade, self.ibkrLot.dtclose):
+                self.assertEqual(
+                    Lot._bakedAsOf(DBSession, dtasof).all(),
+                    Lot.asOf(DBSession, dtasof).all())
+                self.assertEqual(
+                    Lot._bakedAsOf(DBSession, dtasof, longs=True).all(),
+                    Lot.longsAsOf(DBSession, dtasof).all())
+                self.assertEqual(
+                    Lot._bakedAsOf(DBSession, dtasof,
+                                   security=self.ibkrLot.security).all(),
+                    Lot.asOf(DBSession, dtasof,
+                             security=self.ibkrLot.security).all())
+
+            # asOf() is a Query; callers can keep refining it
+            lots = Lot.asOf(DBSession, self.invtran2.dttrade).filter(
+                Lot.units < 0).all()
+            self.assertEqual(lots, [self.kmiLot])
+
+    def testLotSumUnitsAsOf(self):
+        with session_scope() as DBSession:
+            DBSession.add_all([self.brkaLot, self.ibkrLot, self.kmiLot])
+
+            # Nothing held before the first INVTRAN
+            self.assertEqual(
+                Lot.sumUnitsAsOf(DBSession, datetime(2015, 1, 1)), Decimal('0'))
+
+            # BRKA long (1) + IBKR long (100) + KMI short (-100)
+            dtasof = self.invtran2.dttrade
+            self.assertEqual(
+                Lot.sumUnitsAsOf(DBSession, dtasof), Decimal('1'))
+            self.assertEqual(
+                Lot.sumUnitsAsOf(DBSession, dtasof, longs=True), Decimal('101'))
+            self.assertEqual(
+                Lot.sumUnitsAsOf(DBSession, dtasof, security=self.secinfo3),
+                Decimal('-100'))
+
     def testLotCsv(self):
         """ Lot should be unchanged after round trip dump/load CSV file """
-        csvfile = 'test.csv'
+        byDtopen = attrgetter('dtopen')
+        # CSV dumps don't preserve opening INVTRAN ('opener')
+        lotState = attrgetter('account', 'security', 'dtopen', 'dtstart',
+                              'units', 'cost', 'washcost')
+
         oldlots = [self.brkaLot, self.ibkrLot, self.kmiLot]
-        oldlots.sort(key=attrgetter('dtopen'))
+        oldlots.sort(key=byDtopen)
         with session_scope() as DBSession:
             DBSession.add_all(oldlots)
             Lot.dumpCsv(DBSession, csvfile, dtasof=self.ibkrLot.dtopen)
@@ -229,23 +376,82 @@ class LotTestCase(unittest.TestCase):
             DBSession.add_all(oldlots)
             lots = Lot.loadCsv(DBSession, csvfile)
             DBSession.add_all(lots)
-            lots.sort(key=attrgetter('dtopen'))
+            lots.sort(key=byDtopen)
             self.assertEqual(len(lots), 3)
             for (lot, oldlot) in zip(lots, oldlots):
-                # CSV dumps don't preserve opening INVTRAN ('opener')
-                for attr in ('account', 'security', 'dtopen', 'dtstart',
-                             'units', 'cost', 'washcost'):
-                    self.assertEqual(getattr(lot, attr), getattr(oldlot, attr))
+                self.assertEqual(lotState(lot), lotState(oldlot))
 
         try:
             os.unlink(csvfile)
         except OSError:  # file not created by test -- probably an error
             pass
 
-class OfxLogTestCase(unittest.TestCase):
+    def testLotLoadCsvCreatesAccountsAndSecurities(self):
+        """ Accounts & securities missing from the DB get created once """
+        with open(csvfile, 'w') as f:
+            f.write('brokerid,acctid,ticker,secname,uniqueidtype,uniqueid,'
+                    'dtopen,units,cost,washcost\n'
+                    '2222,271828,IBKR,Interactive Brokers,CUSIP,45841N107,'
+                    '2016-01-04,100,4233.99,0\n'
+                    '2222,271828,IBKR,Interactive Brokers,CUSIP,45841N107,'
+                    '"January 05, 2016",50,2100,0\n')
+
+        with session_scope() as DBSession:
+            lots = Lot.loadCsv(DBSession, csvfile)
+            self.assertEqual(len(lots), 2)
+            self.assertIs(lots[0].account, lots[1].account)
+            self.assertIs(lots[0].security, lots[1].security)
+            self.assertEqual(lots[0].account.acctid, '271828')
+            self.assertEqual(lots[0].security.uniqueid, '45841N107')
+            self.assertEqual(lots[0].dtopen, datetime(2016, 1, 4))
+            self.assertEqual(lots[1].dtstart, datetime(2016, 1, 5))
+            self.assertEqual(lots[1].units, Decimal('50'))
+            self.assertEqual(lots[1].cost, Decimal('2100'))
+
+        try:
+            os.unlink(csvfile)
+        except OSError:  # file not created by test -- probably an error
+            pass
+
+    def testLotLoadCsvQueryCount(self):
+        """ loadCsv() issues the same statements however many rows it reads """
+        with session_scope() as DBSession:
+            DBSession.add_all([self.acctfrom, self.secinfo1, self.secinfo2])
+
+        counts = []
+        for nrows in (1, 10, 100):
+            with open(csvfile, 'w') as f:
+                f.write(','.join(Lot.csvFields) + '\n')
+                for i in range(nrows):
+                    secinfo = (self.secinfo1, self.secinfo2)[i % 2]
+                    f.write('2222,271828,%s,%s,CUSIP,%s,2016-01-04,%d,%d,0\n'
+                            % (secinfo.ticker, secinfo.secname,
+                               secinfo.uniqueid, i + 1, 10 * (i + 1)))
+
+            queries = []
+            def countQuery(conn, cursor, statement, *args):
+                queries.append(statement)
+
+            with session_scope() as DBSession:
+                event.listen(engine, 'before_cursor_execute', countQuery)
+                try:
+                    lots = Lot.loadCsv(DBSession, csvfile)
+                finally:
+                    event.remove(engine, 'before_cursor_execute', countQuery)
+                self.assertEqual(len(lots), nrows)
+            counts.append(len(queries))
+
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[1], counts[2])
+
+        try:
+            os.unlink(csvfile)
+        except OSError:  # file not created by test -- probably an error
+            pass
+
+class OfxLogTestCase(AlchemyTestCase):
     def setUp(self):
-        ofxalchemy.models.Base.metadata.create_all(engine)
-        Base.metadata.create_all(engine)
+        super(OfxLogTestCase, self).setUp()
 
         self.acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
 
@@ -273,13 +479,6 @@ class OfxLogTestCase(unittest.TestCase):
             subacctsec='CASH', subacctfund='CASH'
         )
 
-    def tearDown(self):
-        pass
-        try:
-            os.unlink(dbfile)
-        except OSError:  # file not created by test -- probably an error
-            pass
-
     def testOfxLogGetOrCreate(self):
         with session_scope() as DBSession:
             ofxlog = OfxLog(invtran=self.invtran1)
@@ -296,13 +495,181 @@ class OfxLogTestCase(unittest.TestCase):
             self.assertEqual(created, True)
 
             # Test all DB instances
-            ofxlogs = DBSession.query(OfxLog).filter(
-                OfxLog.invtran_id == INVTRAN.id
+            ofxlogs = DBSession.query(OfxLog).join(OfxLog.invtran).options(
+                contains_eager(OfxLog.invtran)
             ).order_by(INVTRAN.dttrade).all()
             self.assertEqual(len(ofxlogs), 2)
             self.assertIs(ofxlogs[0], a)
             self.assertIs(ofxlogs[1], b)
 
 
+class IBKRTestCase(AlchemyTestCase):
+    def testParseTransferMemo(self):
+        parse = IBKR.parseTransferMemo
+        self.assertEqual(
+            parse('ABC(123) SPLIT 1 FOR 2 (ABC, ABC CORP, 123)'),
+            ('ABC(123) SPLIT 1 FOR 2', 'ABC', 'ABC CORP', '123'))
+
+        # Commas in the security name
+        self.assertEqual(
+            parse('ABC(123) MERGED (DEF, DEF, INC., 987654321)'),
+            ('ABC(123) MERGED', 'DEF', 'DEF, INC.', '987654321'))
+
+        # Parentheses in the security name
+        self.assertEqual(
+            parse('ABC(123) MERGED (DEF, DEF CORP (NEW), 987654321)'),
+            ('ABC(123) MERGED', 'DEF', 'DEF CORP (NEW)', '987654321'))
+
+        # Text after the closing parenthesis is ignored
+        self.assertEqual(
+            parse('ABC(123) MERGED (DEF, DEF CORP, 987654321) - CORRECTED'),
+            ('ABC(123) MERGED', 'DEF', 'DEF CORP', '987654321'))
+
+        self.assertIsNone(parse('ABC(123) MERGED (DEF)'))
+        self.assertIsNone(parse('(DEF, DEF CORP, 987654321)'))
+
+        # A long memo that doesn't match is rejected in one pass (this would
+        # take minutes with nested open-ended regex groups)
+        self.assertIsNone(parse('X' + ' (A, B' * 50000))
+
+    def testCandidatesCache(self):
+        """ candidates() results don't outlive a commit or rollback """
+        DBSession = Session()
+        try:
+            acctfrom = INVACCTFROM(brokerid='4705', acctid='U123')
+            abc = STOCKINFO(uniqueidtype='CUSIP', uniqueid='123',
+                            ticker='ABC', secname='ABC CORP')
+            dttrade = datetime(2016, 2, 1)
+
+            def transfer(fitid):
+                return TRANSFER(
+                    acctfrom=acctfrom, secinfo=abc, fitid=fitid,
+                    dttrade=dttrade, units=Decimal('-100'),
+                    subacctsec='CASH', tferaction='OUT', postype='LONG',
+                    memo='ABC(123) MERGED (ABC, ABC CORP, 123)')
+
+            def candidates():
+                return IBKR.candidates(
+                    DBSession, TRANSFER, acctfrom_id=acctfrom.id,
+                    dttrade=dttrade)
+
+            a = transfer('a')
+            DBSession.add(a)
+            DBSession.flush()
+            self.assertEqual(candidates(), [a])
+            DBSession.commit()
+
+            # Added since the last lookup
+            DBSession.begin_nested()
+            b = transfer('b')
+            DBSession.add(b)
+            DBSession.flush()
+            self.assertEqual(candidates(), [a, b])
+
+            # Rolled back (to the SAVEPOINT)
+            DBSession.rollback()
+            self.assertEqual(candidates(), [a])
+        finally:
+            DBSession.close()
+
+    def _transferTest(self, secname):
+        """
+        Reorg of a held position in ABC into DEF, whose security name is
+        given; doTransfer() on the incoming side (whose memo carries that
+        name) should move the Lot over to DEF.
+        """
+        with session_scope() as DBSession:
+            acctfrom = INVACCTFROM(brokerid='4705', acctid='U123')
+            abc = STOCKINFO(uniqueidtype='CUSIP', uniqueid='123',
+                            ticker='ABC', secname='ABC CORP')
+            def_ = STOCKINFO(uniqueidtype='CUSIP', uniqueid='987654321',
+                             ticker='DEF', secname=secname)
+            buy = BUYSTOCK(
+                acctfrom=acctfrom, secinfo=abc, fitid='a',
+                dttrade=datetime(2016, 1, 4), buytype='BUY',
+                units=Decimal('100'), unitprice=Decimal('10'),
+                total=Decimal('-1000'), subacctsec='CASH', subacctfund='CASH')
+            dttrade = datetime(2016, 2, 1)
+            transferOut = TRANSFER(
+                acctfrom=acctfrom, secinfo=abc, fitid='b', dttrade=dttrade,
+                units=Decimal('-100'), subacctsec='CASH', tferaction='OUT',
+                postype='LONG', memo='ABC(123) MERGED (ABC, ABC CORP, 123)')
+            transferIn = TRANSFER(
+                acctfrom=acctfrom, secinfo=def_, fitid='c', dttrade=dttrade,
+                units=Decimal('50'), subacctsec='CASH', tferaction='IN',
+                postype='LONG',
+                memo='ABC(123) MERGED (DEF, %s, 987654321)' % secname)
+            DBSession.add_all([buy, transferOut, transferIn])
+            Lot.doTrades(DBSession, [buy])
+
+            IBKR.doTransfer(DBSession, transferIn)
+            DBSession.flush()
+
+            lots = Lot.asOf(DBSession, dttrade).all()
+            self.assertEqual(len(lots), 1)
+            lot = lots[0]
+            self.assertEqual(lot.security, def_)
+            self.assertEqual(lot.units, Decimal('50'))
+            self.assertEqual(lot.cost, Decimal('1000'))
+            self.assertEqual(lot.starter, transferIn)
+            self.assertEqual(lot.predecessor.ender, transferOut)
+
+    def testDoTransferCommaSecname(self):
+        self._transferTest('DEF, INC.')
+
+    def testDoTransferParenthesizedSecname(self):
+        self._transferTest('DEF CORP (NEW)')
+
+
+class InvtranHandlerTestCase(unittest.TestCase):
+    def testInvtranHandler(self):
+        # Default handlers, looked up along the MRO
+        self.assertEqual(invtranHandler('2222', BUYSTOCK), Lot.trade)
+        self.assertIsNone(invtranHandler('2222', TRANSFER))
+        # Broker quirks, falling back to the defaults
+        self.assertEqual(invtranHandler('4705', TRANSFER), IBKR.doTransfer)
+        self.assertEqual(invtranHandler('4705', BUYSTOCK), Lot.trade)
+
+    def testRebuildHandlerTable(self):
+        """ Quirks registered later are picked up after a rebuild """
+        def doIncome(DBSession, invtran):
+            pass
+
+        self.assertIsNone(invtranHandler('2222', INCOME))
+        brokerquirks['2222'] = {INCOME: doIncome}
+        try:
+            rebuildHandlerTable()
+            self.assertIs(invtranHandler('2222', INCOME), doIncome)
+            self.assertEqual(invtranHandler('2222', BUYSTOCK), Lot.trade)
+        finally:
+            del brokerquirks['2222']
+            rebuildHandlerTable()
+        self.assertIsNone(invtranHandler('2222', INCOME))
+
+
+class SchemaTestCase(unittest.TestCase):
+    def testCreateMissingIndexes(self):
+        """ Indexes missing from an existing DB get added """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+
+        def indexes():
+            return {row[0] for row in engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+        expected = indexes()
+        engine.execute('DROP INDEX ix_lot_open')
+        engine.execute('DROP INDEX ix_gain_invtran')
+        self.assertFalse({'ix_lot_open', 'ix_gain_invtran'} & indexes())
+
+        createMissingIndexes(engine)
+        self.assertEqual(indexes(), expected)
+
+        # Nothing to do the second time around
+        createMissingIndexes(engine)
+        self.assertEqual(indexes(), expected)
+        engine.dispose()
+
+
 if __name__=='__main__':
     unittest.main()
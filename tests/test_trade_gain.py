@@ -4,17 +4,19 @@
 import unittest
 import logging
 import sys
-from contextlib import contextmanager
 from datetime import datetime 
 from decimal import Decimal
-import os
+from collections import namedtuple
+from unittest import mock
 
 
 # 3rd party imports
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import (
+    sessionmaker, selectinload, joinedload, contains_eager, raiseload,
+)
+from sqlalchemy.pool import StaticPool
 
-from ofxtools import ofxalchemy
 from ofxtools.ofxalchemy import OFXParser
 from ofxtools.ofxalchemy.models import (
     INVACCTFROM,
@@ -24,10 +26,12 @@ from ofxtools.ofxalchemy.models import (
     BUYSTOCK,
     SELLSTOCK,
     RETOFCAP,
+    SPLIT,
 )
 
 
 # local imports
+import capgains.models
 from capgains.models import (
     Base,
     Lot,
@@ -40,38 +44,104 @@ from capgains.models import (
 #logger.level = logging.INFO
 
 
-### DB SETUP
-engine = create_engine('sqlite:///test.db', echo=False)
-Session = sessionmaker(bind=engine)
+### FIXTURE CONSTANTS
+# Every trade pays the same commission; parse it once (Decimals are immutable)
+COMMISSION = Decimal('9.99')
 
-@contextmanager
-def session_scope():
+
+### DB SETUP
+# One in-memory DB per process (so per pytest-xdist worker), shared by every
+# connection via StaticPool
+engine = create_engine('sqlite://', echo=False,
+                       connect_args={'check_same_thread': False},
+                       poolclass=StaticPool)
+Session = sessionmaker(expire_on_commit=False)
+
+# pysqlite's own transaction handling doesn't play well with SAVEPOINT;
+# take it over so each test can run in one that gets rolled back.
+@event.listens_for(engine, 'connect')
+def _disablePysqliteBegin(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(engine, 'begin')
+def _emitBegin(conn):
+    conn.execute('BEGIN')
+
+# Durability doesn't matter for a test DB.  (An in-memory DB keeps its
+# journal in memory already; temp tables & sort spills should too.)
+@event.listens_for(engine, 'connect')
+def _setPragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+def setUpModule():
+    # capgains models share ofxalchemy's MetaData; one pass creates both
+    Base.metadata.create_all(engine)
+
+def tearDownModule():
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+def insertFixture(DBSession, model, **values):
     """
-    Provide a transactional scope around a series of database operations.
+    INSERT a fixture row without going through the unit of work, and return
+    it loaded.  ofxalchemy models are polymorphic, so the bulk INSERT has to
+    be given the discriminator.
     """
-    session = Session()
-    try:
-        yield session
-        session.commit()
-    except:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+    mapper = model.__mapper__
+    values[mapper.polymorphic_on.key] = mapper.polymorphic_identity
+    DBSession.bulk_insert_mappings(model, [values], return_defaults=True)
+    return DBSession.query(model).get(values['id'])
+
+
+# The Lot attributes checked by the trade/wash sale tests, so that a list of
+# Lots can be compared against its expected values in one assertion
+LotView = namedtuple('LotView', 'units cost dtopen opener dtclose closer')
+
+def lotView(lot):
+    return LotView(lot.units, lot.cost, lot.dtopen, lot.opener,
+                   lot.dtclose, lot.closer)
 
 
 ### TEST CASES
 class AlchemyTestCase(unittest.TestCase):
+    """
+    Tests share one connection per class, inside a transaction that's rolled
+    back at the end.  Each test gets a Session (self.session) and runs in a
+    SAVEPOINT that tearDown() rolls back.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = engine.connect()
+        cls.transaction = cls.connection.begin()
+        Session.configure(bind=cls.connection)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.transaction.rollback()
+        cls.connection.close()
+
     def setUp(self):
-        ofxalchemy.models.Base.metadata.create_all(engine)
-        Base.metadata.create_all(engine)
+        self.savepoint = self.connection.begin_nested()
+        self.session = Session()
 
     def tearDown(self):
-        pass
-        try:
-            os.unlink('test.db')
-        except OSError:  # file not created by test -- probably an error
-            pass
+        self.session.close()
+        self.savepoint.rollback()
+
+    def _makeAcctSec(self, DBSession):
+        """ The account & security that every test trades in """
+        acctfrom = insertFixture(DBSession, INVACCTFROM,
+                                 brokerid='2222', acctid='271828')
+        security = insertFixture(
+            DBSession, STOCKINFO,
+            uniqueid='123456789', uniqueidtype='CUSIP',
+            secname='Acme Development, Inc.', ticker='ACME', fiid='1024',
+        )
+        return acctfrom, security
 
 
 #class LoggingTestCase(AlchemyTestCase):
@@ -87,71 +157,79 @@ class AlchemyTestCase(unittest.TestCase):
 
 
 class TradeGainTestCase(AlchemyTestCase):
-    def testTrade(self):
-        with session_scope() as DBSession:
-            acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
-            DBSession.add(acctfrom)
-
-            security = STOCKINFO(
-                uniqueid='123456789', uniqueidtype='CUSIP',
-                secname='Acme Development, Inc.', ticker='ACME', fiid='1024',
-            )
-            DBSession.add(security)
-
-            trade1 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
-                buytype='BUY', units=Decimal('300'), unitprice=Decimal('10.00'),
-                commission=Decimal('9.99'), total=Decimal('-3009.99'),
-                subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(trade1)
-
-            trade2 = SELLSTOCK(
-                acctfrom=acctfrom,
-                fitid='b', dttrade=datetime(2005, 12, 1), secinfo=security,
-                selltype='SELL', units=Decimal('-200'), unitprice=Decimal('12'),
-                commission=Decimal('9.99'), total=Decimal('2390.01'),
-                subacctsec='CASH', subacctfund='CASH',
-            )
-            DBSession.add(trade2)
-
-            # Calculate Lots and Gains on the trades
-            Lot.trade(DBSession, trade1)
-            Lot.trade(DBSession, trade2)
-
-            self._invstmtrs2_test(DBSession)
-
-            # No wash sales, so results should be the same after calculation
-            Gain.doWashSales(DBSession)
+    def _doTrades(self, DBSession, acctfrom, security, trades):
+        """
+        Build BUYSTOCK/SELLSTOCK (by sign of units) from
+        (fitid, dttrade, units, unitprice, total) tuples and calculate
+        Lots and Gains on them.
+        """
+        invtrans = []
+        for fitid, dttrade, units, unitprice, total in trades:
+            if units > 0:
+                model, kwargs = BUYSTOCK, {'buytype': 'BUY'}
+            else:
+                model, kwargs = SELLSTOCK, {'selltype': 'SELL'}
+            invtrans.append(model(
+                acctfrom=acctfrom, secinfo=security, fitid=fitid,
+                dttrade=dttrade, units=units, unitprice=unitprice,
+                commission=COMMISSION, total=total,
+                subacctsec='CASH', subacctfund='CASH', **kwargs))
+        Lot.doTrades(DBSession, invtrans)
+        return invtrans
 
-            self._invstmtrs2_test(DBSession)
+    def testTrade(self):
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+
+        # Calculate Lots and Gains on the trades
+        trade1, trade2 = self._doTrades(DBSession, acctfrom, security, [
+            # (fitid, dttrade, units, unitprice, total)
+            ('a', datetime(2005, 10, 3), Decimal('300'),
+             Decimal('10.00'), Decimal('-3009.99')),
+            ('b', datetime(2005, 12, 1), Decimal('-200'),
+             Decimal('12'), Decimal('2390.01')),
+        ])
 
-    def _invstmtrs2_test(self, DBSession):
-        trade1, trade2 = DBSession.query(INVTRAN).order_by(INVTRAN.dttrade).all()
         # When Lots/Gains are calculated, the initial Lot of 300sh gets
-        # split in 2.
-        lots = DBSession.query(Lot).all()
+        # split in 2.  Load everything the assertions walk up front.
+        # raiseload() turns any relationship we forgot into a test failure
+        lots = DBSession.query(Lot).options(
+            selectinload(Lot.gains).joinedload(Gain.transaction),
+            joinedload(Lot.opener), joinedload(Lot.closer),
+            joinedload(Lot.starter), joinedload(Lot.ender),
+            raiseload('*'),
+        ).order_by(Lot.id).all()
+        gain = DBSession.query(Gain).options(
+            joinedload(Gain.lot), joinedload(Gain.transaction)).one()
+
+        self._invstmtrs2_test(DBSession, trade1, trade2, lots, gain)
+
+        # No wash sales, so results should be the same after calculation.
+        # The loaded Lots/Gain stay in the identity map; just make sure
+        # nothing new was created.
+        Gain.doWashSales(DBSession)
+        self.assertEqual(DBSession.query(Lot).count(), 2)
+        self.assertEqual(DBSession.query(Gain).count(), 1)
+
+        self._invstmtrs2_test(DBSession, trade1, trade2, lots, gain)
+
+    def _invstmtrs2_test(self, DBSession, trade1, trade2, lots, gain):
         self.assertEqual(len(lots), 2)
         lot1, lot2 = lots
 
-        # Lot 1: 200sh closed, cost 200/300 * -3,009.99 = $2,006.66
-        self.assertEqual(lot1.units, Decimal('200'))
-        self.assertEqual(lot1.cost, Decimal('2006.66'))
-        self.assertEqual(lot1.opener, trade1)
-        self.assertEqual(lot1.dtclose, datetime(2005, 12, 1))
-        #self.assertEqual(lot1.washed, False)
-
-        # Lot 2: 100sh open, cost 100/300 * -3,009.99 = $1,003.33
-        self.assertEqual(lot2.units, Decimal('100'))
-        self.assertEqual(lot2.cost, Decimal('1003.33'))
-        self.assertEqual(lot2.opener, trade1)
-        self.assertEqual(lot2.dtclose, None)
-        #self.assertEqual(lot2.washed, False)
+        self.assertEqual([lotView(lot) for lot in lots], [
+            # Lot 1: 200sh closed, cost 200/300 * -3,009.99 = $2,006.66
+            LotView(units=Decimal('200'), cost=Decimal('2006.66'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=datetime(2005, 12, 1), closer=trade2),
+            # Lot 2: 100sh open, cost 100/300 * -3,009.99 = $1,003.33
+            LotView(units=Decimal('100'), cost=Decimal('1003.33'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=None, closer=None),
+        ])
 
         # Gain on sale: proceeds of 200 @ $12.00 - $9.99 = $2,390.01
         #               less cost of $2,006.66 = gain of $383.35 (STCG) 
-        gain = DBSession.query(Gain).one()
         self.assertEqual(gain.proceeds, Decimal('2390.01'))
         self.assertEqual(gain.washloss, Decimal('0')) 
         self.assertEqual(gain.lot, lot1)
@@ -160,6 +238,10 @@ class TradeGainTestCase(AlchemyTestCase):
         self.assertEqual(gain.value, Decimal('383.35'))
         self.assertFalse(gain.isLongTerm)
 
+        # Same values computed by the DB via the hybrid expressions
+        self.assertEqual(DBSession.query(Gain.value).scalar(), Decimal('383.35'))
+        self.assertEqual(DBSession.query(Gain).filter(Gain.isLongTerm).count(), 0)
+
         # Test the relationship from Lot to Gain
         self.assertEqual(len(lot1.gains), 1)
         self.assertEqual(lot1.gains[0], gain)
@@ -171,494 +253,573 @@ class TradeGainTestCase(AlchemyTestCase):
         """
         Wash sale where replacement units don't consume all the loss units
         """
-        with session_scope() as DBSession:
-            acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
-            DBSession.add(acctfrom)
-
-            # Create some OFX import data
-            security = STOCKINFO(
-                uniqueid='123456789', uniqueidtype='CUSIP',
-                secname='Acme Development, Inc.', ticker='ACME', fiid='1024',
-            )
-            DBSession.add(security)
-
-            trade1 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
-                buytype='BUY', units=Decimal('300'), unitprice=Decimal('10.00'),
-                commission=Decimal('9.99'), total=Decimal('-3009.99'),
-                subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(trade1)
-
-            trade2 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='b', dttrade=datetime(2005, 11, 1), secinfo=security,
-                buytype='BUY', units=Decimal('300'), unitprice=Decimal('5.00'),
-                commission=Decimal('9.99'), total=Decimal('-1509.99'),
-                subacctsec='CASH', subacctfund='CASH',
-            )
-            DBSession.add(trade2)
-
-            trade3 = SELLSTOCK(
-                acctfrom=acctfrom,
-                fitid='c', dttrade=datetime(2005, 12, 1), secinfo=security,
-                selltype='SELL', units=Decimal('-400'), 
-                unitprice=Decimal('8.00'), commission=Decimal('9.99'), 
-                total=Decimal('3190.01'), subacctsec='CASH', subacctfund='CASH',
-            )
-            DBSession.add(trade3)
-
-            # Calculate Lots and Gains on the trades
-            Lot.trade(DBSession, trade1)
-            Lot.trade(DBSession, trade2)
-            Lot.trade(DBSession, trade3)
-
-            # When Lots/Gains are calculated, the first Lot of 300sh gets
-            # closed unmodified, and the second lot gets split in 2.
-            lots = DBSession.query(Lot).all()
-            self.assertEqual(len(lots), 3)
-            lot1, lot2, lot3 = lots
-
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+
+        # Calculate Lots and Gains on the trades
+        trade1, trade2, trade3 = self._doTrades(DBSession, acctfrom, security, [
+            # (fitid, dttrade, units, unitprice, total)
+            ('a', datetime(2005, 10, 3), Decimal('300'),
+             Decimal('10.00'), Decimal('-3009.99')),
+            ('b', datetime(2005, 11, 1), Decimal('300'),
+             Decimal('5.00'), Decimal('-1509.99')),
+            ('c', datetime(2005, 12, 1), Decimal('-400'),
+             Decimal('8.00'), Decimal('3190.01')),
+        ])
+
+        # When Lots/Gains are calculated, the first Lot of 300sh gets
+        # closed unmodified, and the second lot gets split in 2.
+        lots = DBSession.query(Lot).options(
+            selectinload(Lot.gains),
+            joinedload(Lot.opener), joinedload(Lot.closer),
+            joinedload(Lot.starter), joinedload(Lot.ender),
+            raiseload('*'),
+        ).order_by(Lot.id).all()
+        self.assertEqual(len(lots), 3)
+        lot1, lot2, lot3 = lots
+
+        self.assertEqual([lotView(lot) for lot in lots], [
             # Lot 1: 300sh closed, cost -3,009.99
-            self.assertEqual(lot1.units, Decimal('300'))
-            self.assertEqual(lot1.cost, Decimal('3009.99'))
-            self.assertEqual(lot1.dtopen, trade1.dttrade)
-            self.assertEqual(lot1.opener, trade1)
-            #self.assertEqual(lot1.dtclose, datetime(2005, 12, 1))
-            self.assertEqual(lot1.dtclose, trade3.dttrade)
-            self.assertEqual(lot1.closer, trade3)
-            #self.assertEqual(lot1.washed, False)
-
+            LotView(units=Decimal('300'), cost=Decimal('3009.99'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=trade3.dttrade, closer=trade3),
             # Lot 2: 100sh closed, cost 100/300 * -1,509.99 = $503.33
-            self.assertEqual(lot2.units, Decimal('100'))
-            self.assertEqual(lot2.cost, Decimal('503.33'))
-            self.assertEqual(lot2.dtopen, trade2.dttrade)
-            self.assertEqual(lot2.opener, trade2)
-            self.assertEqual(lot2.dtclose, datetime(2005, 12, 1))
-            self.assertEqual(lot2.closer, trade3)
-            #self.assertEqual(lot2.washed, False)
-
+            LotView(units=Decimal('100'), cost=Decimal('503.33'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=datetime(2005, 12, 1), closer=trade3),
             # Lot 3: 200sh open, cost 200/300 * -1,509.99 = $1,006.66
-            self.assertEqual(lot3.units, Decimal('200'))
-            self.assertEqual(lot3.cost, Decimal('1006.66'))
-            self.assertEqual(lot3.dtopen, trade2.dttrade)
-            self.assertEqual(lot3.opener, trade2)
-            self.assertEqual(lot3.dtclose, None)
-            self.assertEqual(lot3.closer, None)
-            #self.assertEqual(lot3.washed, False)
-
-            gains = DBSession.query(Gain).filter(
-                Gain.invtran_id == INVTRAN.id,
-            ).order_by(INVTRAN.dttrade).all()
-            self.assertEqual(len(gains), 2)
-            gain1, gain2 = gains
-
-            # Gain 1: proceeds of 300/400 * $3,190.01 = $2,392.5075
-            #         less cost of $3,009.99 = loss of -$617.4825 (STCG) 
-            self.assertEqual(gain1.lot, lot1)
-            self.assertEqual(gain1.proceeds, Decimal('2392.5075'))
-            self.assertEqual(gain1.transaction, trade3)
-            self.assertEqual(gain1.cost, Decimal('3009.99'))
-            self.assertEqual(gain1.value, Decimal('-617.4825'))
-            self.assertEqual(gain1.washloss, Decimal('0')) 
-            self.assertFalse(gain1.isLongTerm)
-
-            # Gain 2: proceeds of 100/400 * $3,190.01 = $797.5025
-            #         less cost of $503.33 = gain of $294.1725 (STCG) 
-            self.assertEqual(gain2.lot, lot2)
-            self.assertEqual(gain2.proceeds, Decimal('797.5025'))
-            self.assertEqual(gain2.transaction, trade3)
-            self.assertEqual(gain2.cost, Decimal('503.33'))
-            self.assertEqual(gain2.value, Decimal('294.1725'))
-            self.assertEqual(gain2.washloss, Decimal('0')) 
-            self.assertFalse(gain2.isLongTerm)
-
-            # Test the relationship from Lot to Gain
-            self.assertEqual(len(lot1.gains), 1)
-            self.assertEqual(lot1.gains[0], gain1)
-
-            self.assertEqual(len(lot2.gains), 1)
-            self.assertEqual(lot2.gains[0], gain2)
-
-            # Account for wash sales
-            Gain.doWashSales(DBSession)
+            LotView(units=Decimal('200'), cost=Decimal('1006.66'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=None, closer=None),
+        ])
+
+        gains = DBSession.query(Gain).join(Gain.transaction).options(
+            contains_eager(Gain.transaction), joinedload(Gain.lot),
+        ).order_by(INVTRAN.dttrade, Gain.id).all()
+        self.assertEqual(len(gains), 2)
+        gain1, gain2 = gains
+
+        # Gain 1: proceeds of 300/400 * $3,190.01 = $2,392.5075
+        #         less cost of $3,009.99 = loss of -$617.4825 (STCG) 
+        self.assertEqual(gain1.lot, lot1)
+        self.assertEqual(gain1.proceeds, Decimal('2392.5075'))
+        self.assertEqual(gain1.transaction, trade3)
+        self.assertEqual(gain1.cost, Decimal('3009.99'))
+        self.assertEqual(gain1.value, Decimal('-617.4825'))
+        self.assertEqual(gain1.washloss, Decimal('0')) 
+        self.assertFalse(gain1.isLongTerm)
+
+        # Gain 2: proceeds of 100/400 * $3,190.01 = $797.5025
+        #         less cost of $503.33 = gain of $294.1725 (STCG) 
+        self.assertEqual(gain2.lot, lot2)
+        self.assertEqual(gain2.proceeds, Decimal('797.5025'))
+        self.assertEqual(gain2.transaction, trade3)
+        self.assertEqual(gain2.cost, Decimal('503.33'))
+        self.assertEqual(gain2.value, Decimal('294.1725'))
+        self.assertEqual(gain2.washloss, Decimal('0')) 
+        self.assertFalse(gain2.isLongTerm)
+
+        # Test the relationship from Lot to Gain
+        self.assertEqual(len(lot1.gains), 1)
+        self.assertEqual(lot1.gains[0], gain1)
 
-            # When wash sales are accounted for, all of trade2 units are
-            # replacement shares for trade3 units.  As such, all of gain1
-            # is a wash sale; its loss is disallowed and rolled into the 
-            # cost basis of Lots created by trade2 (i.e. lot2 and lot 3).
-            self.assertEqual(DBSession.query(Lot).count(), 3)
+        self.assertEqual(len(lot2.gains), 1)
+        self.assertEqual(lot2.gains[0], gain2)
 
+        # Account for wash sales
+        Gain.doWashSales(DBSession)
+
+        # When wash sales are accounted for, all of trade2 units are
+        # replacement shares for trade3 units.  As such, all of gain1
+        # is a wash sale; its loss is disallowed and rolled into the 
+        # cost basis of Lots created by trade2 (i.e. lot2 and lot 3).
+        self.assertEqual(DBSession.query(Lot).count(), 3)
+
+        self.assertEqual([lotView(lot) for lot in lots], [
             # Lot 1 should be unaffected by the wash sale calculations
-            self.assertEqual(lot1.units, Decimal('300'))
-            self.assertEqual(lot1.cost, Decimal('3009.99'))
-            self.assertEqual(lot1.opener, trade1)
-            self.assertEqual(lot1.dtclose, datetime(2005, 12, 1))
-
-            # Lot 2 gets extra cost basis of 100/300 * $617.4825 = -$205.8275
-            self.assertEqual(lot2.units, Decimal('100'))
-            self.assertEqual(lot2.cost, Decimal('503.33'))
-            self.assertEqual(lot2.washcost, Decimal('205.8275'))
-            self.assertEqual(lot2.opener, trade2)
-            self.assertEqual(lot2.dtclose, datetime(2005, 12, 1))
-
-            # Lot 3 gets extra cost basis of 200/300 * $617.4825 = -$411.6550
-            self.assertEqual(lot3.units, Decimal('200'))
-            self.assertEqual(lot3.cost, Decimal('1006.66'))
-            self.assertEqual(lot3.washcost, Decimal('411.6550'))
-            self.assertEqual(lot3.opener, trade2)
-            self.assertEqual(lot3.dtclose, None)
-            #self.assertEqual(lot3.washed, True)
-
-            # No new Gains should have been created
-            self.assertEqual(DBSession.query(Gain).count(), 2)
-
-            # Gain 1: proceeds of 300/400 * $3,190.01 = $2,392.5075
-            #         less cost of $3,009.99 = loss of -$617.4825 (STCG) 
-            #         Loss of -$617.4825 disallowed
-            self.assertEqual(gain1.lot, lot1)
-            self.assertEqual(gain1.transaction, trade3)
-            self.assertEqual(gain1.proceeds, Decimal('2392.5075'))
-            self.assertEqual(gain1.units, Decimal('300'))
-            self.assertEqual(gain1.cost, Decimal('3009.99'))
-            self.assertEqual(gain1.value, Decimal('-617.4825'))
-            self.assertEqual(gain1.washcost, Decimal('0'))
-            self.assertEqual(gain1.taxcost, gain1.cost)
-            self.assertEqual(gain1.washloss, Decimal('-617.4825')) 
-            self.assertEqual(gain1.taxvalue, gain1.value)
-            self.assertFalse(gain1.isLongTerm)
-
-            # Gain 2: proceeds of 100/400 * $3,190.01 = $797.5025
-            #         less cost of $503.33 = gain of $294.1725 (STCG) 
-            #         Disallowed loss of 100/300 * $617.4825 = -$205.8275
-            #         rolled into basis
-            self.assertEqual(gain2.lot, lot2)
-            self.assertEqual(gain2.transaction, trade3)
-            self.assertEqual(gain2.proceeds, Decimal('797.5025'))
-            self.assertEqual(gain2.units, Decimal('100'))
-            self.assertEqual(gain2.cost, Decimal('503.33'))
-            self.assertEqual(gain2.value, Decimal('294.1725'))
-            self.assertEqual(gain2.washcost, Decimal('205.8275'))
-            self.assertEqual(gain2.taxcost, gain2.cost + gain2.washcost)
-            self.assertEqual(gain2.washloss, Decimal('0')) 
-            self.assertEqual(gain2.taxvalue, gain2.proceeds - gain2.taxcost)
-            self.assertFalse(gain2.isLongTerm)
+            LotView(units=Decimal('300'), cost=Decimal('3009.99'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=datetime(2005, 12, 1), closer=trade3),
+            LotView(units=Decimal('100'), cost=Decimal('503.33'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=datetime(2005, 12, 1), closer=trade3),
+            LotView(units=Decimal('200'), cost=Decimal('1006.66'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=None, closer=None),
+        ])
+        # Lot 2 gets extra cost basis of 100/300 * $617.4825 = -$205.8275
+        self.assertEqual(lot2.washcost, Decimal('205.8275'))
+        # Lot 3 gets extra cost basis of 200/300 * $617.4825 = -$411.6550
+        self.assertEqual(lot3.washcost, Decimal('411.6550'))
+        #self.assertEqual(lot3.washed, True)
+
+        # No new Gains should have been created
+        self.assertEqual(DBSession.query(Gain).count(), 2)
+
+        # Gain 1: proceeds of 300/400 * $3,190.01 = $2,392.5075
+        #         less cost of $3,009.99 = loss of -$617.4825 (STCG) 
+        #         Loss of -$617.4825 disallowed
+        self.assertEqual(gain1.lot, lot1)
+        self.assertEqual(gain1.transaction, trade3)
+        self.assertEqual(gain1.proceeds, Decimal('2392.5075'))
+        self.assertEqual(gain1.units, Decimal('300'))
+        self.assertEqual(gain1.cost, Decimal('3009.99'))
+        self.assertEqual(gain1.value, Decimal('-617.4825'))
+        self.assertEqual(gain1.washcost, Decimal('0'))
+        self.assertEqual(gain1.taxcost, gain1.cost)
+        self.assertEqual(gain1.washloss, Decimal('-617.4825')) 
+        self.assertEqual(gain1.taxvalue, gain1.value)
+        self.assertFalse(gain1.isLongTerm)
+
+        # Gain 2: proceeds of 100/400 * $3,190.01 = $797.5025
+        #         less cost of $503.33 = gain of $294.1725 (STCG) 
+        #         Disallowed loss of 100/300 * $617.4825 = -$205.8275
+        #         rolled into basis
+        self.assertEqual(gain2.lot, lot2)
+        self.assertEqual(gain2.transaction, trade3)
+        self.assertEqual(gain2.proceeds, Decimal('797.5025'))
+        self.assertEqual(gain2.units, Decimal('100'))
+        self.assertEqual(gain2.cost, Decimal('503.33'))
+        self.assertEqual(gain2.value, Decimal('294.1725'))
+        self.assertEqual(gain2.washcost, Decimal('205.8275'))
+        self.assertEqual(gain2.taxcost, gain2.cost + gain2.washcost)
+        self.assertEqual(gain2.washloss, Decimal('0')) 
+        self.assertEqual(gain2.taxvalue, gain2.proceeds - gain2.taxcost)
+        self.assertFalse(gain2.isLongTerm)
 
     def testWashSale2(self):
         """
         Wash sale where there are more replacement units than units
         where gain is disallowed
         """
-        with session_scope() as DBSession:
-            acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
-            DBSession.add(acctfrom)
-
-            # Create some OFX import data
-            security = STOCKINFO(
-                uniqueid='123456789', uniqueidtype='CUSIP',
-                secname='Acme Development, Inc.', ticker='ACME', fiid='1024',
-            )
-            DBSession.add(security)
-
-            trade1 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
-                buytype='BUY', units=Decimal('200'), unitprice=Decimal('10.00'),
-                commission=Decimal('9.99'), total=Decimal('-2009.99'),
-                subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(trade1)
-
-            trade2 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='b', dttrade=datetime(2005, 11, 1), secinfo=security,
-                buytype='BUY', units=Decimal('500'), unitprice=Decimal('5.00'),
-                commission=Decimal('9.99'), total=Decimal('-2509.99'),
-                subacctsec='CASH', subacctfund='CASH',
-            )
-            DBSession.add(trade2)
-
-            trade3 = SELLSTOCK(
-                acctfrom=acctfrom,
-                fitid='c', dttrade=datetime(2005, 12, 1), secinfo=security,
-                selltype='SELL', units=Decimal('-500'),
-                unitprice=Decimal('8.00'), commission=Decimal('9.99'),
-                total=Decimal('3990.01'), subacctsec='CASH', subacctfund='CASH',
-            )
-            DBSession.add(trade3)
-
-            # Calculate Lots and Gains on the trades
-            Lot.trade(DBSession, trade1)
-            Lot.trade(DBSession, trade2)
-            Lot.trade(DBSession, trade3)
-
-            # When Lots/Gains are calculated, the first Lot of 300sh gets
-            # closed unmodified, and the second lot gets split in 2.
-            lots = DBSession.query(Lot).filter(
-                Lot.opener_id== INVTRAN.id,).order_by(INVTRAN.dttrade)
-            self.assertEqual(lots.count(), 3)
-            lot1, lot2, lot3 = lots
-
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+
+        # Calculate Lots and Gains on the trades
+        trade1, trade2, trade3 = self._doTrades(DBSession, acctfrom, security, [
+            # (fitid, dttrade, units, unitprice, total)
+            ('a', datetime(2005, 10, 3), Decimal('200'),
+             Decimal('10.00'), Decimal('-2009.99')),
+            ('b', datetime(2005, 11, 1), Decimal('500'),
+             Decimal('5.00'), Decimal('-2509.99')),
+            ('c', datetime(2005, 12, 1), Decimal('-500'),
+             Decimal('8.00'), Decimal('3990.01')),
+        ])
+
+        # When Lots/Gains are calculated, the first Lot of 300sh gets
+        # closed unmodified, and the second lot gets split in 2.
+        lots = DBSession.query(Lot).join(Lot.opener).order_by(
+            INVTRAN.dttrade, Lot.id)
+        self.assertEqual(lots.count(), 3)
+        lot1, lot2, lot3 = lots
+
+        self.assertEqual([lotView(lot) for lot in lots], [
             # Lot 1: 200sh closed, cost 2,009.99
-            self.assertEqual(lot1.units, Decimal('200'))
-            self.assertEqual(lot1.cost, Decimal('2009.99'))
-            self.assertEqual(lot1.dtopen, trade1.dttrade)
-            self.assertEqual(lot1.opener, trade1)
-            self.assertEqual(lot1.dtclose, trade3.dttrade)
-            self.assertEqual(lot1.closer, trade3)
-
+            LotView(units=Decimal('200'), cost=Decimal('2009.99'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=trade3.dttrade, closer=trade3),
             # Lot 2: 300sh closed, cost $1,505.99
-            self.assertEqual(lot2.units, Decimal('300'))
-            self.assertEqual(lot2.cost, Decimal('1505.994'))
-            self.assertEqual(lot2.dtopen, trade2.dttrade)
-            self.assertEqual(lot2.opener, trade2)
-            self.assertEqual(lot2.dtclose, trade3.dttrade)
-            self.assertEqual(lot2.closer, trade3)
-
+            LotView(units=Decimal('300'), cost=Decimal('1505.994'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=trade3.dttrade, closer=trade3),
             # Lot 3: 200sh open, cost -$1,004.00
-            self.assertEqual(lot3.units, Decimal('200'))
-            self.assertEqual(lot3.cost, Decimal('1003.996'))
-            self.assertEqual(lot3.dtopen, trade2.dttrade)
-            self.assertEqual(lot3.opener, trade2)
-            self.assertEqual(lot3.dtclose, None)
-            self.assertEqual(lot3.closer, None)
-
-            gains = DBSession.query(Gain)
-            self.assertEqual(gains.count(), 2)
-            gain1, gain2 = gains
-
-            # Gain 1: proceeds $1,596.00 - cost $2,009.99 = loss -$413.99 (STCG) 
-            self.assertEqual(gain1.proceeds, Decimal('1596.004'))
-            self.assertEqual(gain1.lot, lot1)
-            self.assertEqual(gain1.transaction, trade3)
-            self.assertEqual(gain1.units, Decimal('200'))
-            self.assertEqual(gain1.cost, Decimal('2009.99'))
-            self.assertEqual(gain1.proceeds, Decimal('1596.004'))
-            self.assertEqual(gain1.value, Decimal('-413.986'))
-            self.assertEqual(gain1.washloss, Decimal('0')) 
-            self.assertFalse(gain1.isLongTerm)
-
-            # Gain 2: proceeds $1,596.00 - cost $2,009.99 = loss -$413.99 (STCG) 
-            self.assertEqual(gain2.proceeds, Decimal('2394.006'))
-            self.assertEqual(gain2.lot, lot2)
-            self.assertEqual(gain2.transaction, trade3)
-            self.assertEqual(gain2.units, Decimal('300'))
-            self.assertEqual(gain2.cost, Decimal('1505.994'))
-            self.assertEqual(gain2.proceeds, Decimal('2394.006'))
-            self.assertEqual(gain2.value, Decimal('888.012'))
-            self.assertEqual(gain2.washloss, Decimal('0')) 
-            self.assertFalse(gain2.isLongTerm)
-
-            # Test the relationship from Lot to Gain
-            self.assertEqual(len(lot1.gains), 1)
-            self.assertIs(lot1.gains[0], gain1)
-
-            self.assertEqual(len(lot2.gains), 1)
-            self.assertIs(lot2.gains[0], gain2)
-
-            # Account for wash sales
-            Gain.doWashSales(DBSession)
-
-            # When wash sales are accounted for, 200 of lot2's 300 units are
-            # replacement shares for gain1 units.  As such, lot2
-            # gets split into a Lot of 200 replacement units, with the
-            # disallowed loss on gain1 rolled in, and 100 unwashed shares.
-            # When lot2 gets split, its corresponding gain2 also gets
-            # split accordingly.
-            lots = DBSession.query(Lot).filter(
-                Lot.opener_id == INVTRAN.id,
-            ).order_by(INVTRAN.dttrade)
-            self.assertEqual(lots.count(), 4)
-            lot1, lot2, lot3, lot4 = lots
+            LotView(units=Decimal('200'), cost=Decimal('1003.996'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=None, closer=None),
+        ])
+
+        gains = DBSession.query(Gain)
+        self.assertEqual(gains.count(), 2)
+        gain1, gain2 = gains
+
+        # Gain 1: proceeds $1,596.00 - cost $2,009.99 = loss -$413.99 (STCG) 
+        self.assertEqual(gain1.proceeds, Decimal('1596.004'))
+        self.assertEqual(gain1.lot, lot1)
+        self.assertEqual(gain1.transaction, trade3)
+        self.assertEqual(gain1.units, Decimal('200'))
+        self.assertEqual(gain1.cost, Decimal('2009.99'))
+        self.assertEqual(gain1.proceeds, Decimal('1596.004'))
+        self.assertEqual(gain1.value, Decimal('-413.986'))
+        self.assertEqual(gain1.washloss, Decimal('0')) 
+        self.assertFalse(gain1.isLongTerm)
+
+        # Gain 2: proceeds $1,596.00 - cost $2,009.99 = loss -$413.99 (STCG) 
+        self.assertEqual(gain2.proceeds, Decimal('2394.006'))
+        self.assertEqual(gain2.lot, lot2)
+        self.assertEqual(gain2.transaction, trade3)
+        self.assertEqual(gain2.units, Decimal('300'))
+        self.assertEqual(gain2.cost, Decimal('1505.994'))
+        self.assertEqual(gain2.proceeds, Decimal('2394.006'))
+        self.assertEqual(gain2.value, Decimal('888.012'))
+        self.assertEqual(gain2.washloss, Decimal('0')) 
+        self.assertFalse(gain2.isLongTerm)
 
+        # Test the relationship from Lot to Gain
+        self.assertEqual(len(lot1.gains), 1)
+        self.assertIs(lot1.gains[0], gain1)
+
+        self.assertEqual(len(lot2.gains), 1)
+        self.assertIs(lot2.gains[0], gain2)
+
+        # Account for wash sales
+        Gain.doWashSales(DBSession)
+
+        # When wash sales are accounted for, 200 of lot2's 300 units are
+        # replacement shares for gain1 units.  As such, lot2
+        # gets split into a Lot of 200 replacement units, with the
+        # disallowed loss on gain1 rolled in, and 100 unwashed shares.
+        # When lot2 gets split, its corresponding gain2 also gets
+        # split accordingly.
+        lots = DBSession.query(Lot).join(Lot.opener).order_by(
+            INVTRAN.dttrade, Lot.id)
+        self.assertEqual(lots.count(), 4)
+        lot1, lot2, lot3, lot4 = lots
+
+        self.assertEqual([lotView(lot) for lot in lots], [
             # Lot 1 should be unaffected by the wash sale calculations
-            self.assertEqual(lot1.units, Decimal('200'))
-            self.assertEqual(lot1.cost, Decimal('2009.99'))
-            self.assertEqual(lot1.dtopen, trade1.dttrade)
-            self.assertEqual(lot1.opener, trade1)
-            self.assertEqual(lot1.dtclose, trade3.dttrade)
-            self.assertEqual(lot1.closer, trade3)
-
+            LotView(units=Decimal('200'), cost=Decimal('2009.99'),
+                    dtopen=trade1.dttrade, opener=trade1,
+                    dtclose=trade3.dttrade, closer=trade3),
             # Lot 2 gets split - 200 units are replacement shares for lot1.
-            # lot1 was closed in gain1; all of gain1's loss (i.e. -413.986)
-            # is disallowed and rolled into lot2's cost basis.
-            self.assertEqual(lot2.units, Decimal('200'))
-            self.assertEqual(lot2.cost, Decimal('1003.996'))
-            self.assertEqual(lot2.washcost,  Decimal('413.986'))
-            self.assertEqual(lot2.dtopen, trade2.dttrade)
-            self.assertEqual(lot2.opener, trade2)
-            self.assertEqual(lot2.dtclose, trade3.dttrade)
-            self.assertEqual(lot2.closer, trade3)
-
+            LotView(units=Decimal('200'), cost=Decimal('1003.996'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=trade3.dttrade, closer=trade3),
             # Lot 3 should be unaffected by the wash sale calculations
-            self.assertEqual(lot1.units, Decimal('200'))
-            self.assertEqual(lot3.units, Decimal('200'))
-            self.assertEqual(lot3.cost, Decimal('1003.996'))
-            self.assertEqual(lot3.dtopen, trade2.dttrade)
-            self.assertEqual(lot3.opener, trade2)
-            self.assertEqual(lot3.dtclose, None)
-            self.assertEqual(lot3.closer, None)
-
+            LotView(units=Decimal('200'), cost=Decimal('1003.996'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=None, closer=None),
             # Lot 4 is the extra units from Lot 2
             # Cost basis of 100/300 * $1,505.99 = $501.998
-            self.assertEqual(lot4.units, Decimal('100'))
-            self.assertEqual(lot4.cost, Decimal('501.998'))
-            self.assertEqual(lot4.dtopen, trade2.dttrade)
-            self.assertEqual(lot4.opener, trade2)
-            self.assertEqual(lot4.dtclose, trade3.dttrade)
-            self.assertEqual(lot4.closer, trade3)
-
-            gains = DBSession.query(Gain)
-            self.assertEqual(gains.count(), 3)
-            gain1, gain2, gain3 = gains
-
-            # gain1: value of -$413.986 is disallowed
-            self.assertEqual(gain1.lot, lot1)
-            self.assertEqual(gain1.transaction, trade3)
-            self.assertEqual(gain1.proceeds, Decimal('1596.004'))
-            self.assertEqual(gain1.units, Decimal('200'))
-            self.assertEqual(gain1.cost, Decimal('2009.99'))
-            self.assertEqual(gain1.proceeds, Decimal('1596.004'))
-            self.assertEqual(gain1.value, Decimal('-413.986'))
-            self.assertEqual(gain1.washloss, Decimal('-413.986')) 
-            self.assertFalse(gain1.isLongTerm)
-
-            # gain2 has been split; it's now the 200 replacement shares
-            self.assertEqual(gain2.lot, lot2)
-            self.assertEqual(gain2.transaction, trade3)
-            self.assertEqual(gain2.units, Decimal('200'))
-            self.assertEqual(gain2.cost, Decimal('1003.996'))
-            self.assertEqual(gain2.proceeds, Decimal('1596.004'))
-            self.assertEqual(gain2.value, Decimal('592.008'))
-            self.assertEqual(gain2.washloss, Decimal('0')) 
-            self.assertFalse(gain2.isLongTerm)
-
-            # gain3 is the 100sh split from gain2 that aren't replacement shares
-            self.assertEqual(gain3.lot, lot4)
-            self.assertEqual(gain3.transaction, trade3)
-            self.assertEqual(gain3.units, Decimal('100'))
-            self.assertEqual(gain3.cost, Decimal('501.998'))
-            self.assertEqual(gain3.proceeds, Decimal('798.002'))
-            self.assertEqual(gain3.value, Decimal('296.004'))
-            self.assertEqual(gain3.washloss, Decimal('0')) 
-            self.assertFalse(gain3.isLongTerm)
+            LotView(units=Decimal('100'), cost=Decimal('501.998'),
+                    dtopen=trade2.dttrade, opener=trade2,
+                    dtclose=trade3.dttrade, closer=trade3),
+        ])
+        # lot1 was closed in gain1; all of gain1's loss (i.e. -413.986)
+        # is disallowed and rolled into lot2's cost basis.
+        self.assertEqual(lot2.washcost,  Decimal('413.986'))
+
+        gains = DBSession.query(Gain)
+        self.assertEqual(gains.count(), 3)
+        gain1, gain2, gain3 = gains
+
+        # gain1: value of -$413.986 is disallowed
+        self.assertEqual(gain1.lot, lot1)
+        self.assertEqual(gain1.transaction, trade3)
+        self.assertEqual(gain1.proceeds, Decimal('1596.004'))
+        self.assertEqual(gain1.units, Decimal('200'))
+        self.assertEqual(gain1.cost, Decimal('2009.99'))
+        self.assertEqual(gain1.proceeds, Decimal('1596.004'))
+        self.assertEqual(gain1.value, Decimal('-413.986'))
+        self.assertEqual(gain1.washloss, Decimal('-413.986')) 
+        self.assertFalse(gain1.isLongTerm)
+
+        # gain2 has been split; it's now the 200 replacement shares
+        self.assertEqual(gain2.lot, lot2)
+        self.assertEqual(gain2.transaction, trade3)
+        self.assertEqual(gain2.units, Decimal('200'))
+        self.assertEqual(gain2.cost, Decimal('1003.996'))
+        self.assertEqual(gain2.proceeds, Decimal('1596.004'))
+        self.assertEqual(gain2.value, Decimal('592.008'))
+        self.assertEqual(gain2.washloss, Decimal('0')) 
+        self.assertFalse(gain2.isLongTerm)
+
+        # gain3 is the 100sh split from gain2 that aren't replacement shares
+        self.assertEqual(gain3.lot, lot4)
+        self.assertEqual(gain3.transaction, trade3)
+        self.assertEqual(gain3.units, Decimal('100'))
+        self.assertEqual(gain3.cost, Decimal('501.998'))
+        self.assertEqual(gain3.proceeds, Decimal('798.002'))
+        self.assertEqual(gain3.value, Decimal('296.004'))
+        self.assertEqual(gain3.washloss, Decimal('0')) 
+        self.assertFalse(gain3.isLongTerm)
+
+    def testIsLongTermBoundary(self):
+        """
+        Long term means more than 365 whole 24-hour periods held, not 366
+        calendar days; the instance and SQL forms of isLongTerm agree.
+        """
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+        buy, sellShort, sellLong = self._doTrades(
+            DBSession, acctfrom, security, [
+                # (fitid, dttrade, units, unitprice, total)
+                ('a', datetime(2015, 1, 1, 15), Decimal('200'),
+                 Decimal('10'), Decimal('-2009.99')),
+                # 366 calendar days later, but only 365 days 19 hours
+                ('b', datetime(2016, 1, 2, 10), Decimal('-100'),
+                 Decimal('12'), Decimal('1190.01')),
+                # 366 days 1 hour
+                ('c', datetime(2016, 1, 2, 16), Decimal('-100'),
+                 Decimal('12'), Decimal('1190.01')),
+            ])
+
+        gains = DBSession.query(Gain).join(Gain.transaction).order_by(
+            INVTRAN.dttrade).all()
+        self.assertEqual([gain.transaction for gain in gains],
+                         [sellShort, sellLong])
+        self.assertEqual([gain.isLongTerm for gain in gains], [False, True])
+        self.assertEqual(
+            DBSession.query(Gain).filter(Gain.isLongTerm).all(), [gains[1]])
+        self.assertEqual(
+            DBSession.query(Gain).filter(~Gain.isLongTerm).all(), [gains[0]])
+
+    def testWashSalesManySecurities(self):
+        """
+        doWashSales() looks up replacement Lots for more account/security
+        pairs than fit in one SELECT
+        """
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+        securities = [security] + [
+            insertFixture(DBSession, STOCKINFO, uniqueid='00000000%d' % i,
+                          uniqueidtype='CUSIP', ticker='T%d' % i,
+                          secname='Test %d' % i)
+            for i in range(4)
+        ]
+        replacements = []
+        for i, security in enumerate(securities):
+            buy, sell, rebuy = self._doTrades(
+                DBSession, acctfrom, security, [
+                    # (fitid, dttrade, units, unitprice, total)
+                    ('a%d' % i, datetime(2005, 10, 3), Decimal('100'),
+                     Decimal('10'), Decimal('-1000')),
+                    ('b%d' % i, datetime(2005, 11, 1), Decimal('-100'),
+                     Decimal('8'), Decimal('800')),
+                    ('c%d' % i, datetime(2005, 11, 15), Decimal('100'),
+                     Decimal('10'), Decimal('-1000')),
+                ])
+            replacements.append(rebuy.openedlots[0])
+
+        # 5 account/security pairs, 2 per SELECT
+        with mock.patch.object(capgains.models, 'LOOKUP_CHUNKSIZE', 2):
+            Gain.doWashSales(DBSession)
+        DBSession.flush()
+
+        self.assertEqual([lot.washcost for lot in replacements],
+                         [Decimal('200')] * len(securities))
+        self.assertEqual(
+            [gain.washloss for gain in DBSession.query(Gain)],
+            [Decimal('-200')] * len(securities))
+
+    def _fractionalWashSale(self, DBSession):
+        """
+        Wash sale whose replacement units are fractional, so they only net
+        out exactly to zero in Decimal.  Returns the loss Gain and the
+        replacement Lots.
+        """
+        acctfrom, security = self._makeAcctSec(DBSession)
+        trades = self._doTrades(DBSession, acctfrom, security, [
+            # (fitid, dttrade, units, unitprice, total)
+            ('a', datetime(2020, 1, 1), Decimal('1'),
+             Decimal('100'), Decimal('-100')),
+            ('b', datetime(2020, 1, 10), Decimal('0.7'),
+             Decimal('10'), Decimal('-7')),
+            ('c', datetime(2020, 1, 11), Decimal('0.3'),
+             Decimal('10'), Decimal('-3')),
+            ('d', datetime(2020, 1, 12), Decimal('5'),
+             Decimal('10'), Decimal('-50')),
+            ('e', datetime(2020, 1, 15), Decimal('-1'),
+             Decimal('10'), Decimal('10')),
+        ])
+        gain = DBSession.query(Gain).one()
+        replacements = DBSession.query(Lot).filter(
+            Lot.opener_id.in_([trade.id for trade in trades[1:4]])
+        ).order_by(Lot.dtopen).all()
+        return gain, replacements
+
+    def _fractionalWashSaleTest(self, DBSession, gain, replacements):
+        DBSession.flush()
+        self.assertEqual(gain.washloss, Decimal('-90'))
+        self.assertEqual(
+            [(lot.units, lot.washcost) for lot in replacements],
+            [(Decimal('0.7'), Decimal('63')), (Decimal('0.3'), Decimal('27')),
+             (Decimal('5'), Decimal('0'))])
+        # Nothing got split off
+        self.assertEqual(DBSession.query(Lot).count(), 4)
+
+    def testWashSaleFractionalUnits(self):
+        """
+        Wash sale on fractional replacement units, via doWashSales()
+        (replacement Lots chosen from a preloaded pool)
+        """
+        DBSession = self.session
+        gain, replacements = self._fractionalWashSale(DBSession)
+        Gain.doWashSales(DBSession)
+        self._fractionalWashSaleTest(DBSession, gain, replacements)
+
+    def testWashSaleFractionalUnitsQueried(self):
+        """
+        Wash sale on fractional replacement units, via doWashSale() with
+        no candidateLots (replacement Lots queried from the DB)
+        """
+        DBSession = self.session
+        gain, replacements = self._fractionalWashSale(DBSession)
+        gain.doWashSale(DBSession)
+        self._fractionalWashSaleTest(DBSession, gain, replacements)
 
 
 class ReturnOfCapitalTestCase(AlchemyTestCase):
     def testReturnOfCapital(self):
-        with session_scope() as DBSession:
-            acctfrom = INVACCTFROM(brokerid='2222', acctid='271828')
-            DBSession.add(acctfrom)
-
-            # Create some OFX import data
-            security = STOCKINFO(
-                uniqueid='123456789', uniqueidtype='CUSIP',
-                secname='Acme Development, Inc.', ticker='ACME', fiid='1024',
-            )
-            DBSession.add(security)
-
-            trade1 = BUYSTOCK(
-                acctfrom=acctfrom,
-                fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
-                buytype='BUY', units=Decimal('300'), unitprice=Decimal('10.00'),
-                commission=Decimal('9.99'), total=Decimal('-3009.99'),
-                subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(trade1)
-
-            # Create the Lot
-            Lot.trade(DBSession, trade1)
-
-            # 1st return of capital - $3,000
-            # Remaining basis of $9.99; no gain
-            retofcap1 = RETOFCAP(
-                acctfrom=acctfrom,
-                fitid='b', dttrade=datetime(2005, 10, 4), secinfo=security,
-                total=Decimal('3000'), subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(retofcap1)
-            Lot.returnOfCapital(DBSession, retofcap1)
-
-            # 2nd return of capital - $1,000
-            # Basis reduced to 0; gain of $990.01
-            retofcap2 = RETOFCAP(
-                acctfrom=acctfrom,
-                fitid='c', dttrade=datetime(2005, 10, 5), secinfo=security,
-                total=Decimal('1000'), subacctsec='CASH', subacctfund='CASH'
-            )
-            DBSession.add(retofcap2)
-            Lot.returnOfCapital(DBSession, retofcap2)
-
-            # Before the returns of capital, there should be one Lot
-            # with cost=$3,009.99 and no Gain
-            lots = Lot.asOf(DBSession, datetime(2005, 10, 3)).all()
-            self.assertEqual(len(lots), 1)
-            lot = lots[0]
-            
-            self.assertEqual(lot.units, trade1.units)
-            self.assertEqual(lot.cost, -trade1.total)
-            self.assertEqual(lot.dtopen, trade1.dttrade)
-            self.assertEqual(lot.opener, trade1)
-            self.assertEqual(lot.dtclose, None)
-            self.assertEqual(lot.closer, None)
-            self.assertEqual(lot.starter, trade1)
-            self.assertEqual(lot.dtstart, trade1.dttrade)
-            self.assertEqual(lot.ender, retofcap1)
-            self.assertEqual(lot.dtend, retofcap1.dttrade)
-            self.assertEqual(lot.predecessor, None)
-            self.assertEqual(lot.washcost, Decimal('0'))
-            self.assertEqual(len(lot.gains), 0)
-
-            # After the 1st return of capital, there should be one Lot
-            # with cost=$9.99 and no Gain
-            lots = Lot.asOf(DBSession, datetime(2005, 10, 4)).all()
-            self.assertEqual(len(lots), 1)
-            lot = lots[0]
-            
-            self.assertEqual(lot.units, Decimal('300'))
-            #self.assertEqual(lot.cost, Decimal('9.99'))
-            self.assertEqual(lot.cost, -trade1.total - retofcap1.total)
-            self.assertEqual(lot.dtopen, trade1.dttrade)
-            self.assertEqual(lot.opener, trade1)
-            self.assertEqual(lot.dtclose, None)
-            self.assertEqual(lot.closer, None)
-            self.assertEqual(lot.starter, retofcap1)
-            self.assertEqual(lot.dtstart, retofcap1.dttrade)
-            self.assertEqual(lot.ender, retofcap2)
-            self.assertEqual(lot.dtend, retofcap2.dttrade)
-            #self.assertEqual(lot.predecessor, None)
-            self.assertEqual(lot.washcost, Decimal('0'))
-            self.assertEqual(len(lot.gains), 0)
-
-            # After the 2nd return of capital, there should be one Lot
-            # with zero cost and a Gain of $990.01
-            lots = Lot.asOf(DBSession, datetime(2005, 10, 5)).all()
-            self.assertEqual(len(lots), 1)
-            lot = lots[0]
-            
-            self.assertEqual(lot.units, Decimal('300'))
-            self.assertEqual(lot.cost, Decimal('0'))
-            self.assertEqual(lot.dtopen, trade1.dttrade)
-            self.assertEqual(lot.opener, trade1)
-            self.assertEqual(lot.dtclose, None)
-            self.assertEqual(lot.closer, None)
-            self.assertEqual(lot.starter, retofcap2)
-            self.assertEqual(lot.dtstart, retofcap2.dttrade)
-            self.assertEqual(lot.dtend, None)
-            self.assertEqual(lot.ender, None)
-            #self.assertEqual(lot.predecessor, None)
-            self.assertEqual(lot.washcost, Decimal('0'))
-
-            self.assertEqual(len(lot.gains), 1)
-            gain = lot.gains[0]
-            self.assertAlmostEqual(gain.proceeds, Decimal('990.01'))
-            self.assertEqual(gain.washloss, Decimal('0')) 
-            self.assertEqual(gain.lot, lot)
-            self.assertEqual(gain.transaction, retofcap2)
-            self.assertEqual(gain.cost, Decimal('0'))
-            self.assertAlmostEqual(gain.value, Decimal('990.01'))
-            self.assertFalse(gain.isLongTerm)
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+
+        # Create some OFX import data
+        trade1 = BUYSTOCK(
+            acctfrom=acctfrom,
+            fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
+            buytype='BUY', units=Decimal('300'), unitprice=Decimal('10.00'),
+            commission=COMMISSION, total=Decimal('-3009.99'),
+            subacctsec='CASH', subacctfund='CASH'
+        )
+        DBSession.add(trade1)
+
+        # Create the Lot
+        Lot.trade(DBSession, trade1)
+
+        # 1st return of capital - $3,000
+        # Remaining basis of $9.99; no gain
+        retofcap1 = RETOFCAP(
+            acctfrom=acctfrom,
+            fitid='b', dttrade=datetime(2005, 10, 4), secinfo=security,
+            total=Decimal('3000'), subacctsec='CASH', subacctfund='CASH'
+        )
+        DBSession.add(retofcap1)
+        Lot.returnOfCapital(DBSession, retofcap1)
+
+        # 2nd return of capital - $1,000
+        # Basis reduced to 0; gain of $990.01
+        retofcap2 = RETOFCAP(
+            acctfrom=acctfrom,
+            fitid='c', dttrade=datetime(2005, 10, 5), secinfo=security,
+            total=Decimal('1000'), subacctsec='CASH', subacctfund='CASH'
+        )
+        DBSession.add(retofcap2)
+        Lot.returnOfCapital(DBSession, retofcap2)
+
+        # Before the returns of capital, there should be one Lot
+        # with cost=$3,009.99 and no Gain
+        lots = Lot.asOf(DBSession, datetime(2005, 10, 3)).all()
+        self.assertEqual(len(lots), 1)
+        lot = lots[0]
+
+        self.assertEqual(lot.units, trade1.units)
+        self.assertEqual(lot.cost, -trade1.total)
+        self.assertEqual(lot.dtopen, trade1.dttrade)
+        self.assertEqual(lot.opener, trade1)
+        self.assertEqual(lot.dtclose, None)
+        self.assertEqual(lot.closer, None)
+        self.assertEqual(lot.starter, trade1)
+        self.assertEqual(lot.dtstart, trade1.dttrade)
+        self.assertEqual(lot.ender, retofcap1)
+        self.assertEqual(lot.dtend, retofcap1.dttrade)
+        self.assertEqual(lot.predecessor, None)
+        self.assertEqual(lot.washcost, Decimal('0'))
+        self.assertEqual(len(lot.gains), 0)
+
+        # After the 1st return of capital, there should be one Lot
+        # with cost=$9.99 and no Gain
+        lots = Lot.asOf(DBSession, datetime(2005, 10, 4)).all()
+        self.assertEqual(len(lots), 1)
+        lot = lots[0]
+
+        self.assertEqual(lot.units, Decimal('300'))
+        #self.assertEqual(lot.cost, Decimal('9.99'))
+        self.assertEqual(lot.cost, -trade1.total - retofcap1.total)
+        self.assertEqual(lot.dtopen, trade1.dttrade)
+        self.assertEqual(lot.opener, trade1)
+        self.assertEqual(lot.dtclose, None)
+        self.assertEqual(lot.closer, None)
+        self.assertEqual(lot.starter, retofcap1)
+        self.assertEqual(lot.dtstart, retofcap1.dttrade)
+        self.assertEqual(lot.ender, retofcap2)
+        self.assertEqual(lot.dtend, retofcap2.dttrade)
+        #self.assertEqual(lot.predecessor, None)
+        self.assertEqual(lot.washcost, Decimal('0'))
+        self.assertEqual(len(lot.gains), 0)
+
+        # After the 2nd return of capital, there should be one Lot
+        # with zero cost and a Gain of $990.01
+        lots = Lot.asOf(DBSession, datetime(2005, 10, 5)).all()
+        self.assertEqual(len(lots), 1)
+        lot = lots[0]
+
+        self.assertEqual(lot.units, Decimal('300'))
+        self.assertEqual(lot.cost, Decimal('0'))
+        self.assertEqual(lot.dtopen, trade1.dttrade)
+        self.assertEqual(lot.opener, trade1)
+        self.assertEqual(lot.dtclose, None)
+        self.assertEqual(lot.closer, None)
+        self.assertEqual(lot.starter, retofcap2)
+        self.assertEqual(lot.dtstart, retofcap2.dttrade)
+        self.assertEqual(lot.dtend, None)
+        self.assertEqual(lot.ender, None)
+        #self.assertEqual(lot.predecessor, None)
+        self.assertEqual(lot.washcost, Decimal('0'))
+
+        self.assertEqual(len(lot.gains), 1)
+        gain = lot.gains[0]
+        self.assertAlmostEqual(gain.proceeds, Decimal('990.01'))
+        self.assertEqual(gain.washloss, Decimal('0')) 
+        self.assertEqual(gain.lot, lot)
+        self.assertEqual(gain.transaction, retofcap2)
+        self.assertEqual(gain.cost, Decimal('0'))
+        self.assertAlmostEqual(gain.value, Decimal('990.01'))
+        self.assertFalse(gain.isLongTerm)
+
+
+
+class SplitTestCase(AlchemyTestCase):
+    def testSplit(self):
+        DBSession = self.session
+        acctfrom, security = self._makeAcctSec(DBSession)
+
+        # Create some OFX import data
+        trade1 = BUYSTOCK(
+            acctfrom=acctfrom,
+            fitid='a', dttrade=datetime(2005, 10, 3), secinfo=security,
+            buytype='BUY', units=Decimal('300'), unitprice=Decimal('10.00'),
+            commission=COMMISSION, total=Decimal('-3009.99'),
+            subacctsec='CASH', subacctfund='CASH'
+        )
+        DBSession.add(trade1)
+
+        # Create the Lot
+        Lot.trade(DBSession, trade1)
+
+        # 3:2 split
+        split = SPLIT(
+            acctfrom=acctfrom,
+            fitid='b', dttrade=datetime(2005, 10, 4), secinfo=security,
+            oldunits=Decimal('300'), newunits=Decimal('450'),
+            numerator=Decimal('3'), denominator=Decimal('2'),
+            subacctsec='CASH',
+        )
+        DBSession.add(split)
+        Lot.split(DBSession, split)
+
+        # Before the split, there should be one Lot of 300 units,
+        # ended by the split
+        lots = Lot.asOf(DBSession, datetime(2005, 10, 3)).all()
+        self.assertEqual(len(lots), 1)
+        oldlot = lots[0]
+        self.assertEqual(oldlot.units, Decimal('300'))
+        self.assertEqual(oldlot.ender, split)
+        self.assertEqual(oldlot.dtend, split.dttrade)
+
+        # After the split, there should be one Lot of 450 units with the
+        # same cost & holding period, succeeding the old Lot
+        lots = Lot.asOf(DBSession, datetime(2005, 10, 4)).all()
+        self.assertEqual(len(lots), 1)
+        lot = lots[0]
+        self.assertEqual(lot.units, Decimal('450'))
+        self.assertEqual(lot.cost, -trade1.total)
+        self.assertEqual(lot.dtopen, trade1.dttrade)
+        self.assertEqual(lot.opener, trade1)
+        self.assertEqual(lot.starter, split)
+        self.assertEqual(lot.dtstart, split.dttrade)
+        self.assertEqual(lot.dtend, None)
+        self.assertEqual(lot.predecessor, oldlot)
+        self.assertEqual(oldlot.successor, lot)
 
 
 if __name__=='__main__':